@@ -1,48 +1,49 @@
 # new dependency; pip install deep-translator
 # documentation: https://pypi.org/project/deep-translator/
 # many options for translating, Google Translate currently used.
-from deep_translator import GoogleTranslator
-from deepl import Translator
-
-#get api key from environment variable
 import os
-DEEPL_API_KEY = os.getenv("DEEPL_API_KEY")
+import sys
+
+# Translation goes through the shared, cached client layer of the web app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web'))
+from translation import get_translation_client
 
-# Choose model. Google Translate for development, DeepL for final.
-model = 'google'
-# model = 'deepl'
+# Choose backend. Google Translate for development, DeepL for final. See translation.BACKENDS.
+backend = 'google'
+# backend = 'deepl'
+# backend = 'hedged'  # DeepL, hedged with Google Translate when it is slow or failing
 
-def __googletranslate(source='auto', target='en', text=''):
-    # https://pypi.org/project/deep-translator/#google-translate-1
-    return GoogleTranslator(source=source, target=target).translate(text)
 
+# Source language code for the backend. Google Translate always detects the source language itself.
+def __source(source):
+    return 'auto' if backend == 'google' else source
 
-def __deeptranslate(source=None, target='en-us', text='', context=None, split_sentences=0, preserve_formatting=False, formality='prefer_less',glossary_id=None):
-    # https://developers.deepl.com/docs/api-reference/translate
-    # possible glossary implementation
-    if DEEPL_API_KEY is not None:
-        translator = Translator(auth_key=DEEPL_API_KEY)
-    else:
-        raise ValueError(f"No API key set. \n Please set your DeepL API key in your environment config as the 'DEEPL_API_KEY' variable")
 
-    return translator.translate_text(source_lang=source,
-                                     target_lang=target,
-                                     text=text,
-                                     context=context,
-                                     split_sentences=split_sentences,
-                                     preserve_formatting=preserve_formatting,
-                                     formality=formality).text
+# DeepL options of the old per-call translator. The shared client always uses DeepL's defaults for them, so other
+# values are rejected rather than silently ignored. Google Translate never supported them and ignores them as before.
+def __check_deepl_options(split_sentences, preserve_formatting, glossary_id):
+    if backend == 'google':
+        return
+    unsupported = [name for name, value, default in (('split_sentences', split_sentences, 0),
+                                                      ('preserve_formatting', preserve_formatting, False),
+                                                      ('glossary_id', glossary_id, None)) if value != default]
+    if unsupported:
+        raise ValueError(f"{', '.join(unsupported)} not supported by the shared translation client, "
+                         f"leave them at their defaults")
 
 
 # Current translator in use. Typically set to Google Translate to avoid spending character tokens.
 # Only import this translate function.
+# Clients are created once per backend and reused, and repeated phrases are answered from the translation cache.
 def translate(source=None, target='en', text='', context=None, split_sentences=0, preserve_formatting=False, formality='prefer_less',glossary_id=None):
-    if model == 'google':
-        return __googletranslate(source='auto', target=target, text=text)
-    elif model == 'deepl':
-        return __deeptranslate(source=source, target=target, text=text, context=context, split_sentences=split_sentences, preserve_formatting=preserve_formatting, formality=formality,glossary_id=glossary_id)
-    else:
-        print(f'Choose a valid model')
+    __check_deepl_options(split_sentences, preserve_formatting, glossary_id)
+    return get_translation_client(backend).translate(text, __source(source), target, context=context, formality=formality)
+
+
+# Translate several texts with a single request to the backend.
+def translate_batch(source=None, target='en', texts=(), context=None, formality='prefer_less'):
+    return get_translation_client(backend).translate_batch(list(texts), __source(source), target, context=context, formality=formality)
+
 
 if __name__ == '__main__':
     #expect: Hola, esto es una prueba.
@@ -55,4 +56,4 @@ if __name__ == '__main__':
 
     #expect: Today Mom died. Or maybe yesterday, I don't know.
     #works
-    print(translate(text="Aujourd'hui Maman est morte. Ou peut-être hier, je ne sais pas"))
\ No newline at end of file
+    print(translate(text="Aujourd'hui Maman est morte. Ou peut-être hier, je ne sais pas"))
@@ -1,10 +1,16 @@
-from flask import Flask, render_template, request, session, send_file
+from flask import Flask, Response, jsonify, render_template, request, session, send_file
 from flask_socketio import SocketIO, emit
 from flask_babel import Babel
-from lumino import Lumino
+from lumino import Lumino, SCENARIOS
+from pipeline import RecognitionPipeline
+from async_pipeline import AsyncRecognitionPipeline, EventLoopThread
+from inference import InferenceScheduler
+from worker_pool import ASR_WORKERS, ProcessInferencePool
+from delta import DeltaEncoder
 from threading import Thread
-from speech_recognition import Microphone
-import time
+import metrics
+import logging
+import os
 import json
 
 # Initialize the Flask application
@@ -19,10 +25,97 @@ LANGUAGES = {
     'zh': '中文'
 }
 
-# Global variables to manage the Lumino instance and threading
-lumino_instance = Lumino()        # Holds the instance of the Lumino class
-recognition_thread = None         # The background thread that runs speech recognition
-audio_sources = Microphone.list_microphone_names()  # List of available microphones
+# Run session pipelines as asyncio tasks in one event loop instead of a thread each, if LUMINO_ASYNC_PIPELINE=1
+ASYNC_PIPELINE = os.getenv('LUMINO_ASYNC_PIPELINE') == '1'
+
+# Encoding of line updates sent to the browser: 'json', or 'msgpack' for binary messages if msgpack is installed
+SOCKET_ENCODING = os.getenv('LUMINO_SOCKET_ENCODING', 'json')
+if SOCKET_ENCODING == 'msgpack':
+    try:
+        import msgpack  # noqa: F401
+    except ImportError:
+        print("msgpack is not installed, sending line updates as JSON")
+        SOCKET_ENCODING = 'json'
+
+# Global variables shared by all connected clients
+# Whisper models shared by all sessions, loaded in the background: in LUMINO_ASR_WORKERS worker processes if set,
+# otherwise one model in this process
+inference = ProcessInferencePool(ASR_WORKERS) if ASR_WORKERS else InferenceScheduler()
+event_loop = EventLoopThread() if ASYNC_PIPELINE else None  # Event loop running the async session pipelines
+sessions = {}                            # Socket session id -> ClientSession of each connected client
+audio_sources = None                     # Names of the server's microphones, listed on first use
+
+
+def list_microphones():
+    """
+    List the microphones of the server, enumerating them on first use rather than at start-up. Capturing from them
+    needs PyAudio, which remote clients streaming audio from the browser do not need, so an empty list is returned
+    when it is not installed.
+
+    Returns:
+        list: Names of the available microphones.
+    """
+    global audio_sources
+    if audio_sources is None:
+        try:
+            from speech_recognition import Microphone
+
+            audio_sources = Microphone.list_microphone_names()
+        except (AttributeError, OSError) as e:
+            print(f"Server microphones unavailable, only browser audio can be used: {e}")
+            audio_sources = []
+    return audio_sources
+
+
+class ClientSession:
+    """
+    State of one connected client: its own Lumino instance (language, scenario, transcript and audio queue)
+    and the background thread running its recognition, or its async pipeline in async mode.
+    """
+
+    def __init__(self, sid):
+        """
+        Initialize the session of a client.
+
+        Args:
+            sid (str): Socket session id of the client.
+        """
+        self.sid = sid
+        self.lumino = Lumino(inference)  # Conversation state of this client, sharing the Whisper model
+        self.lumino.session_id = sid     # Identify this client in the trace log
+        self.lumino.on_language_change = self.language_changed  # Show languages picked by auto detection
+        self.recognition_thread = None   # The background thread that runs speech recognition
+        self.pipeline = None             # The async pipeline running speech recognition, in async mode
+        self.recognition_task = None     # Future of the async pipeline's run
+        self.stopping = None             # Future of the stop of the previous async pipeline
+        # Sends the pipeline's results as patches of the text of each line
+        self.updates = DeltaEncoder(self.send, binary=SOCKET_ENCODING == 'msgpack')
+
+    def is_recognizing(self):
+        """
+        Check whether speech recognition is running for this client.
+        """
+        if ASYNC_PIPELINE:
+            return self.recognition_task is not None and not self.recognition_task.done()
+        return self.recognition_thread is not None and self.recognition_thread.is_alive()
+
+    def emit(self, event, data):
+        """
+        Emit a pipeline event to this client only, sending results for a line as patches of its text.
+        """
+        self.updates.emit(event, data)
+
+    def send(self, event, data):
+        """
+        Send a message to this client only.
+        """
+        socketio.emit(event, data, to=self.sid)
+
+    def language_changed(self, new_language):
+        """
+        Notify this client that automatic detection switched the spoken language, as a manual switch does.
+        """
+        self.send('language_switched', {'new_language': new_language})
 
 @app.route("/manifest.json")
 def serve_manifest():
@@ -44,6 +137,29 @@ def serve_sw():
     """
     return send_file('static/sw.js', mimetype='application/javascript')
 
+@app.route('/metrics')
+def serve_metrics():
+    """
+    Serve the pipeline metrics (queue depth, stage latencies, API errors, cache hits, Whisper real-time factor)
+    in the Prometheus text format.
+
+    Returns:
+        The metrics page.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready')
+def serve_ready():
+    """
+    Readiness check: whether the Whisper model is loaded and warmed up.
+
+    Returns:
+        JSON with the readiness, with status 200 when ready and 503 while loading or if loading failed.
+    """
+    if inference.load_error is not None:
+        return jsonify({'ready': False, 'error': str(inference.load_error)}), 503
+    return jsonify({'ready': inference.is_ready()}), 200 if inference.is_ready() else 503
+
 @app.route('/')
 def index():
     """
@@ -55,106 +171,160 @@ def index():
     Returns:
         Rendered HTML template for the index page.
     """
-    selected_microphone = session.get('microphone', 0)  # Get the selected microphone from the session
+    audio_sources = list_microphones()
+    # Get the selected microphone from the session, 'browser' to stream audio from the client's own device
+    selected_microphone = session.get('microphone', 0 if audio_sources else 'browser')
     selected_context = session.get('context', 'General 通用')  # Get the selected context from the session
     selected_language = session.get('lang', 'EN')  # Get the selected language from the session
 
-    scenarios = lumino_instance.get_scenarios()  # Get available scenarios for translation
-
-    # Update session with selected microphone, context, and language if they exist in request arguments
+    # Update session with selected microphone, context, and language if they exist in request arguments.
+    # Each client's Lumino instance picks these up from the session when its socket connects.
     if 'microphone' in request.args:
         selected_microphone = request.args.get('microphone')
         session['microphone'] = selected_microphone
-        lumino_instance.set_input_source(int(selected_microphone))
 
     if 'context' in request.args:
         selected_context = request.args.get('context')
         session['context'] = selected_context
-        lumino_instance.set_context(selected_context)
 
     if 'lang' in request.args:
         selected_language = request.args.get('lang')
         session['lang'] = selected_language
-        lumino_instance.set_language(selected_language)
+
+    mic_name = None if selected_microphone == 'browser' else audio_sources[int(selected_microphone)]
 
     # Render the index.html template with the selected values and options
-    return render_template('index.html', language=lumino_instance.spoken_language, mics=audio_sources,
-                           selected_mic=selected_microphone, mic_name=audio_sources[int(selected_microphone)],
-                           selected_context=selected_context, contexts=scenarios)
+    return render_template('index.html', language=selected_language, mics=audio_sources,
+                           selected_mic=selected_microphone, mic_name=mic_name,
+                           selected_context=selected_context, contexts=SCENARIOS, socket_encoding=SOCKET_ENCODING)
 
-def background_recognition():
+def background_recognition(client):
     """
-    Run speech recognition in a background thread and emit results to the client in real-time.
+    Run the recognition pipeline of a client in a background thread and emit results to it in real-time.
     
-    Continuously listen for speech, process it, and send recognized text, translated text, and generated context
-    to the client using WebSocket events.
+    Recognized text, translated text and generated context are each sent to the client as their own WebSocket
+    event ('recognition_result', 'translation_result' and 'context_result') as soon as that stage has finished,
+    so recognized text never waits on translation or context generation.
+
+    Args:
+        client (ClientSession): The session of the client.
     """
-    global lumino_instance
     try:
-        if lumino_instance is None:
-            lumino_instance = Lumino()
-
-        # Continuously get recognition results from the speech_recognition generator
-        for text, translation, context in lumino_instance.speech_recognition():
-            # Check if the thread should stop
-            if lumino_instance.stop_event.is_set():
-                break
-
-            # Print recognized text and translation to the console
-            print(f"Recognized Text: {text}")
-            print(f"Translated Text: {translation}")
-
-            # Emit the recognized text and translation to the client via WebSocket
-            socketio.emit('recognition_result', {
-                'recognized_text': text,
-                'translated_text': translation,
-                'generated_context': context,
-                'language': lumino_instance.spoken_language,
-                'is_new_line': False  # Set to False to indicate that it's part of the ongoing conversation
-            })
+        if not inference.is_ready():
+            # Recognition was requested while the model is still loading; start as soon as it is ready, unless it
+            # is stopped first
+            while not inference.wait_until_ready(timeout=0.5):
+                if client.lumino.stop_event.is_set():
+                    return
+            client.emit('status', {'status': 'Speech recognition model ready'})
+        if client.lumino.stop_event.is_set():
+            return
+        RecognitionPipeline(client.lumino, client.emit).run()
 
     except Exception as e:
         # If an error occurs, emit the error message to the client
-        socketio.emit('error', {'error': str(e)})
+        client.emit('error', {'error': str(e)})
+
+async def async_recognition(client, pipeline, after):
+    """
+    Run the async recognition pipeline of a client as a task in the event loop, emitting results like
+    background_recognition.
+
+    Args:
+        client (ClientSession): The session of the client.
+        pipeline (AsyncRecognitionPipeline): The pipeline to run.
+        after (concurrent.futures.Future): Stop of the client's previous pipeline to wait for first, or None.
+    """
+    try:
+        await pipeline.run(after)
+
+    except Exception as e:
+        client.emit('error', {'error': str(e)})
+
+@socketio.on('connect')
+def handle_connect():
+    """
+    Handle a new client connection by creating its session state.
+
+    The client's scenario and language are taken from the selections saved in its Flask session.
+    """
+    client = ClientSession(request.sid)
+    client.lumino.set_context(session.get('context', 'General 通用'))
+    if session.get('lang', 'EN') != client.lumino.spoken_language:
+        client.lumino.set_language(session.get('lang'))
+    sessions[request.sid] = client
 
 @socketio.on('start_recognition')
 def handle_start_recognition():
     """
     Handle the 'start_recognition' event from the client to start the speech recognition thread.
     
-    Starts a new background thread for speech recognition if no thread is currently running.
+    Starts a new background thread for the client's speech recognition if it has no thread running. If the Whisper
+    model is still loading, the thread waits for it, so the request is queued rather than rejected.
     """
-    global recognition_thread, lumino_instance
-    if recognition_thread is None or not recognition_thread.is_alive():
+    client = sessions[request.sid]
+    if inference.load_error is not None:
+        emit('error', {'error': f'Speech recognition model failed to load: {inference.load_error}'})
+    elif not client.is_recognizing():
         # Reset stop event to clear any previous stop signals
-        lumino_instance.reset_stop_event()
+        client.lumino.reset_stop_event()
         # Set the input source to the selected microphone from the session
-        selected_microphone = session.get('microphone', 0)
-        lumino_instance.set_input_source(int(selected_microphone))
-        # Create and start a new thread for speech recognition
-        recognition_thread = Thread(target=background_recognition)
-        recognition_thread.start()
-        emit('status', {'status': 'Recognition started'})  # Notify the client that recognition has started
-        time.sleep(1)  # Allow time for microphone setup to complete
+        selected_microphone = session.get('microphone', 0 if list_microphones() else 'browser')
+        if selected_microphone == 'browser':
+            client.lumino.set_capture_mode('browser')
+        else:
+            client.lumino.set_capture_mode('server')
+            client.lumino.set_input_source(int(selected_microphone))
+        if ASYNC_PIPELINE:
+            # Start the pipeline as a task, once the previous one has finished stopping
+            client.pipeline = AsyncRecognitionPipeline(client.lumino, client.emit)
+            client.recognition_task = event_loop.submit(async_recognition(client, client.pipeline, client.stopping))
+        else:
+            # Create and start a new thread for speech recognition
+            client.recognition_thread = Thread(target=background_recognition, args=(client,))
+            client.recognition_thread.start()
+        # Notify the client that recognition has started, or will start once the model has loaded
+        emit('status', {'status': 'Recognition started' if inference.is_ready() else 'Loading speech recognition model, recognition will start when it is ready'})
     else:
         emit('status', {'status': 'Recognition already running'})  # Notify if recognition is already running
 
+@socketio.on('audio_frame')
+def handle_audio_frame(data):
+    """
+    Handle a binary frame of PCM16 audio (16 kHz, mono) streamed from the client's browser.
+
+    The frame is converted straight into the client's preallocated ring buffer.
+
+    Args:
+        data (bytes): Little-endian PCM16 samples.
+    """
+    client = sessions.get(request.sid)
+    if client is not None:
+        client.lumino.audio_buffer.write(data)
+
 @socketio.on('stop_recognition')
 def handle_stop_recognition():
     """
     Handle the 'stop_recognition' event from the client to stop the speech recognition thread.
     
-    Stops the speech recognition thread and clears the conversation content for a new session.
+    Stops the client's speech recognition thread and clears its conversation content for a new session.
     """
-    global recognition_thread, lumino_instance
-    if recognition_thread and recognition_thread.is_alive():
+    client = sessions.get(request.sid)
+    if client and ASYNC_PIPELINE and client.is_recognizing():
+        # Cancel the pipeline task and clear the conversation once it has finished, without waiting for it here
+        client.stopping = event_loop.submit(client.pipeline.stop(clear=True))
+        client.stopping.add_done_callback(lambda _: client.updates.reset())
+        client.pipeline = client.recognition_task = None
+        emit('status', {'status': 'Recognition stopped'})
+    elif client and client.recognition_thread and client.recognition_thread.is_alive():
         # Stop the recognition process
-        lumino_instance.stop_recognition()
-        recognition_thread.join()  # Wait for the recognition thread to finish
-        recognition_thread = None  # Reset the recognition thread variable
+        client.lumino.stop_recognition()
+        client.recognition_thread.join()  # Wait for the recognition thread to finish
+        client.recognition_thread = None  # Reset the recognition thread variable
         emit('status', {'status': 'Recognition stopped'})  # Notify the client that recognition has stopped
         # Clear the conversation content for the new session
-        lumino_instance.clear_conversation()
+        client.lumino.clear_conversation()
+        client.updates.reset()
     else:
         emit('status', {'status': 'No recognition to stop'})  # Notify if there's no recognition running
 
@@ -163,22 +333,33 @@ def handle_switch_language():
     """
     Handle the 'switch_language' event from the client to switch the speaking language.
     
-    Switches between English and Chinese and emits the new language status to the client.
+    Switches between English and Chinese and emits the new language status to the client. A running recognition
+    picks the new language up from the next audio chunk and starts a new line for it, keeping the transcript, the
+    microphone calibration and the audio stream.
     """
-    global recognition_thread, lumino_instance
+    client = sessions[request.sid]
     # Check current language
-    new_language = 'ZH' if lumino_instance.spoken_language == 'EN' else 'EN'
-    lumino_instance.set_language(new_language)
+    new_language = 'ZH' if client.lumino.spoken_language == 'EN' else 'EN'
+    client.lumino.set_language(new_language)
     # Emit events
     emit('language_switched', {'new_language': new_language})
     emit('status', {'status': f'Language switched to {new_language}'})
-    # If the recognition thread is running
-    if recognition_thread and recognition_thread.is_alive():
-        # restart instance
-        handle_stop_recognition()
-        handle_start_recognition()
-    else:
-        print("Recognition is not running, language switched without restart.")
+
+@socketio.on('set_auto_language')
+def handle_set_auto_language(data):
+    """
+    Handle the 'set_auto_language' event from the client to turn automatic language detection on or off.
+
+    In auto mode the spoken language of each utterance is detected by Whisper and picks the translation direction.
+    Takes effect from the next audio chunk of a running recognition.
+
+    Args:
+        data (dict): 'enabled' is true to detect the spoken language.
+    """
+    client = sessions[request.sid]
+    enabled = bool(data.get('enabled'))
+    client.lumino.set_auto_language(enabled)
+    emit('status', {'status': f"Automatic language detection {'on' if enabled else 'off'}"})
 
 @socketio.on('confirm_switch_language')
 def handle_confirm_switch_language():
@@ -187,23 +368,56 @@ def handle_confirm_switch_language():
     
     Sets the new language and emits the confirmation to the client.
     """
-    global lumino_instance
-    new_language = 'ZH' if lumino_instance.spoken_language == 'EN' else 'EN'  # Toggle between English and Chinese
-    lumino_instance.set_language(new_language)
+    client = sessions[request.sid]
+    new_language = 'ZH' if client.lumino.spoken_language == 'EN' else 'EN'  # Toggle between English and Chinese
+    client.lumino.set_language(new_language)
     emit('language_switched', {'new_language': new_language})  # Notify the client of the new language
     emit('status', {'status': f'Language switched to {new_language}'})  # Emit status to indicate language switch
 
+@socketio.on('request_snapshot')
+def handle_request_snapshot():
+    """
+    Send the client a snapshot of its recent lines, when it has missed a line update and needs to resynchronize.
+    """
+    client = sessions.get(request.sid)
+    if client:
+        client.updates.snapshot()
+
+@socketio.on('clear_lines')
+def handle_clear_lines():
+    """
+    Forget the lines the client cleared from its chat window, so later snapshots do not bring them back.
+    """
+    client = sessions.get(request.sid)
+    if client:
+        client.updates.reset()
+
 @socketio.on('disconnect')
 def handle_disconnect():
     """
-    Handle the client's disconnection event to ensure the speech recognition thread is stopped.
+    Handle the client's disconnection event to ensure its speech recognition thread is stopped.
     
-    Stops any ongoing recognition when the client disconnects to free up resources.
+    Stops the client's ongoing recognition, closes its session log and drops its session to free up resources.
+    Other clients are not affected.
     """
-    handle_stop_recognition()  # Call the function to stop recognition
+    client = sessions.pop(request.sid, None)
+    if client and ASYNC_PIPELINE and client.is_recognizing():
+        event_loop.submit(client.pipeline.stop())
+    elif client and client.recognition_thread and client.recognition_thread.is_alive():
+        client.lumino.stop_recognition()
+        client.recognition_thread.join()
+    if client:
+        client.lumino.memory.close()
     print('Client disconnected')  # Log the disconnection on the server side
 
 if __name__ == '__main__':
+    # Write the per-chunk stage timings as JSON lines, to LUMINO_TRACE_LOG if set and otherwise to the console
+    trace_handler = logging.FileHandler(os.environ['LUMINO_TRACE_LOG']) if os.getenv('LUMINO_TRACE_LOG') else logging.StreamHandler()
+    trace_handler.setFormatter(logging.Formatter('%(message)s'))
+    metrics.trace_log.addHandler(trace_handler)
+    metrics.trace_log.setLevel(logging.INFO)
+    metrics.trace_log.propagate = False
+
     # Run the Flask application with SocketIO support, enabling debug mode for development
     socketio.run(app, debug=True)
 
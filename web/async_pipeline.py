@@ -0,0 +1,297 @@
+import asyncio
+import contextlib
+import itertools
+import threading
+import time
+
+from audio import SAMPLE_RATE
+from metrics import API_ERRORS, CONTEXT_CANCELLED, LATENCY_FROM_CAPTURE, STAGE_SECONDS, TRANSLATIONS_CANCELLED
+from pipeline import PHRASE_BOUNDARY
+
+
+class EventLoopThread:
+    """
+    One asyncio event loop running in a background thread, hosting the pipelines of all sessions as tasks.
+
+    Coroutines are submitted from other threads, e.g. Flask-SocketIO handlers, without blocking them.
+    """
+
+    def __init__(self, name="lumino-event-loop"):
+        """
+        Start the event loop thread.
+
+        Args:
+            name (str): Name of the thread.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Run the event loop until the process exits.
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Run a coroutine in the event loop.
+
+        Args:
+            coroutine: The coroutine to run.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+
+class AsyncRecognitionPipeline:
+    """
+    Asyncio version of pipeline.RecognitionPipeline, emitting the same events.
+
+    Speech recognition, translation and context generation of a session run as tasks in one event loop, so a
+    session needs no threads of its own: audio is awaited from the ring buffer, Whisper is awaited through the
+    shared InferenceScheduler, and DeepL and Gemini are called with async clients and per-request timeouts.
+
+    A translation still running when newer text of the same line arrives is cancelled, as is a context stream once
+    newer context is due, unless nothing has been delivered for max_result_age seconds.
+    """
+
+    def __init__(self, lumino, emit, max_result_age=4.0):
+        """
+        Initialize the pipeline.
+
+        Args:
+            lumino (Lumino): The Lumino instance doing the recognition, translation and context generation.
+            emit (callable): Function called as emit(event, data) to deliver results, e.g. socketio.emit.
+            max_result_age (float): Seconds after which context is delivered even if newer context is due.
+        """
+        self.lumino = lumino
+        self.emit = emit
+        self.max_result_age = max_result_age
+        self.task = None  # Task running the pipeline
+        self.audio_ready = None  # Set by the ring buffer writer whenever audio arrives
+        self.translations = {}  # Line -> task translating its latest text
+        self.context_latest = None  # (line, text) context was last requested for
+        self.context_generated = None  # (line, text) context was last generated for
+        self.context_timer = None  # Task waiting until the latest context request is due
+        self.context_task = None  # Task streaming context
+        self.context_streams = itertools.count(1)  # Numbers identifying each context stream
+        self.last_context_delivery = 0.0  # Monotonic time the last complete context was delivered
+
+    async def run(self, after=None):
+        """
+        Run the pipeline until speech recognition stops or the pipeline is stopped. Waits for the session's previous
+        pipeline to stop and for the Whisper model to be ready first; stopping the pipeline meanwhile cancels it.
+
+        Args:
+            after (concurrent.futures.Future): Stop of the session's previous pipeline to wait for first.
+        """
+        # Set before waiting, so a stop while the model is still loading cancels the pipeline instead of missing it
+        self.task = asyncio.current_task()
+        if after is not None:
+            await asyncio.wrap_future(after)
+        inference = self.lumino.inference
+        if not inference.is_ready():
+            await asyncio.to_thread(inference.wait_until_ready)
+            self.emit('status', {'status': 'Speech recognition model ready'})
+        loop = asyncio.get_running_loop()
+        self.audio_ready = asyncio.Event()
+        self.lumino.audio_buffer.on_write = lambda: loop.call_soon_threadsafe(self.audio_ready.set)
+        try:
+            async for audio_np in self.audio_chunks():
+                now = time.monotonic()
+                if audio_np is None:
+                    continue
+                try:
+                    await self.recognize(now, audio_np)
+                except Exception as e:
+                    print(f"Error during recognition: {e}")
+        finally:
+            self.lumino.audio_buffer.on_write = None
+            for task in [*self.translations.values(), self.context_timer, self.context_task]:
+                if task is not None:
+                    task.cancel()
+            self.lumino.finish_recognition()
+
+    async def stop(self, clear=False):
+        """
+        Stop the pipeline and wait for it to finish.
+
+        Args:
+            clear (bool): Whether to clear the conversation once the pipeline has stopped.
+        """
+        self.lumino.stop_recognition()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.wait([self.task])
+        if clear:
+            self.lumino.clear_conversation()
+
+    async def audio_chunks(self):
+        """
+        Get the audio of the session chunk by chunk.
+
+        Yields:
+            np.ndarray: float32 samples of each chunk, or None when no audio arrived for a while.
+        """
+        if self.lumino.capture_mode == 'browser':
+            async for audio_np in self.browser_audio():
+                yield audio_np
+            return
+
+        # The server microphone is recorded by PyAudio in its own thread; wait for its chunks in a worker thread
+        chunks = self.lumino.microphone_audio()
+        loop = asyncio.get_running_loop()
+        finished = object()
+        while True:
+            audio_np = await loop.run_in_executor(None, next, chunks, finished)
+            if audio_np is finished:
+                return
+            yield audio_np
+
+    async def browser_audio(self):
+        """
+        Await audio streamed from the browser into the ring buffer, like Lumino.browser_audio.
+
+        Yields:
+            np.ndarray: float32 samples of each chunk, or None when no audio arrived for a while.
+        """
+        buffer = self.lumino.audio_buffer
+        min_samples = int(self.lumino.record_timeout * SAMPLE_RATE)
+        while not self.lumino.stop_event.is_set():
+            self.audio_ready.clear()  # Before reading, so audio written after the read still wakes us
+            audio_np = buffer.read(min_samples=min_samples, timeout=0)
+            if audio_np is None:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.audio_ready.wait(), 0.25)
+                yield None
+                continue
+            yield audio_np
+            buffer.consume(len(audio_np))
+
+    async def recognize(self, now, audio_np):
+        """
+        Transcribe a chunk, emit the recognized text and start translating it and generating its context.
+
+        Args:
+            now (float): Time the chunk was dequeued, from time.monotonic().
+            audio_np (np.ndarray): float32 samples of the chunk.
+        """
+        language = self.lumino.decoding_language()
+        audio_np, trace = self.lumino.gate_chunk(audio_np)
+        text = ""
+        if audio_np is not None:
+            start = time.monotonic()
+            result = await asyncio.wrap_future(self.lumino.submit_chunk(audio_np, language))
+            text, language = self.lumino.finish_chunk(audio_np, result, time.monotonic() - start, trace)
+        update = self.lumino.add_text(now, text, language)
+        if update is None:
+            return
+
+        line, text, language, is_new_line = update
+        self.emit('recognition_result', {
+            'line': line,
+            'recognized_text': text,
+            'language': language,
+            'is_new_line': is_new_line  # True when the text starts a new line of the conversation
+        })
+        LATENCY_FROM_CAPTURE.labels('recognition').observe(trace.mark('emit', line=line))
+        self.submit_translation(line, text, language, trace)
+        self.submit_context(line, text, trace)
+
+    def submit_translation(self, line, text, language, trace):
+        """
+        Start translating the latest text of a line, cancelling the translation of its previous text.
+        """
+        previous = self.translations.get(line)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            TRANSLATIONS_CANCELLED.inc()
+        task = asyncio.create_task(self.translate(line, text, language, trace))
+        self.translations[line] = task
+
+        def forget(done):
+            if self.translations.get(line) is done:
+                del self.translations[line]
+        task.add_done_callback(forget)
+
+    async def translate(self, line, text, language, trace):
+        """
+        Translate a line and emit the translation, recording the stage time and failed API calls.
+        """
+        start = time.monotonic()
+        try:
+            translation = await self.lumino.translate_line_async(text, language, line=line)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            API_ERRORS.labels('translation').inc()
+            print(f"Error in translation stage: {e}")
+            return
+        finally:
+            STAGE_SECONDS.labels('translation').observe(time.monotonic() - start)
+        print(f"Translated Text: {translation}")
+        self.emit('translation_result', {'line': line, 'translated_text': translation})
+        LATENCY_FROM_CAPTURE.labels('translation').observe(trace.mark('translation', line=line))
+
+    def submit_context(self, line, text, trace):
+        """
+        Schedule context generation for the latest text, like pipeline.ContextScheduler: right away at a phrase
+        boundary, otherwise once no new text has arrived for the quiet interval.
+        """
+        if (line, text) == self.context_latest:
+            return
+        self.context_latest = (line, text)
+        if self.context_timer is not None:
+            self.context_timer.cancel()
+        delay = 0 if PHRASE_BOUNDARY.search(text) else self.lumino.context_quiet_interval
+        self.context_timer = asyncio.create_task(self.schedule_context(delay, line, text, trace))
+
+    async def schedule_context(self, delay, line, text, trace):
+        """
+        Wait until a context request is due, then replace the stream in progress with a stream for it.
+        """
+        await asyncio.sleep(delay)
+        if (line, text) == self.context_generated:
+            return
+        if self.context_task is not None and not self.context_task.done():
+            if time.monotonic() - self.last_context_delivery < self.max_result_age:
+                print(f"Cancelled stale context for line {line}")
+                self.context_task.cancel()
+                CONTEXT_CANCELLED.inc()
+            else:
+                await asyncio.shield(self.context_task)  # Let it finish so continuous speech still gets context
+        self.context_generated = (line, text)
+        self.context_task = asyncio.create_task(self.stream_context(line, text, trace))
+
+    async def stream_context(self, line, text, trace):
+        """
+        Stream the context of a line to the client, recording the stage time and failed API calls.
+        """
+        stream = next(self.context_streams)
+        context = ""
+        first_chunk = True
+        start = time.monotonic()
+        try:
+            async with contextlib.aclosing(self.lumino.generate_context_stream_async(text)) as chunks:
+                async for chunk in chunks:
+                    if first_chunk:
+                        first_chunk = False
+                        LATENCY_FROM_CAPTURE.labels('context_first_chunk').observe(
+                            trace.mark('context_first_chunk', line=line))
+                    context += chunk
+                    self.emit('context_chunk', {'line': line, 'stream': stream, 'delta': chunk})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            API_ERRORS.labels('context').inc()
+            print(f"Error generating context: {e}")
+            return
+        finally:
+            STAGE_SECONDS.labels('context').observe(time.monotonic() - start)
+        self.last_context_delivery = time.monotonic()
+        self.emit('context_result', {'line': line, 'generated_context': context})
+        LATENCY_FROM_CAPTURE.labels('context').observe(trace.mark('context', line=line))
@@ -0,0 +1,191 @@
+import queue
+import threading
+
+import numpy as np
+
+SAMPLE_RATE = 16000  # Whisper expects 16 kHz mono audio
+PCM16_SCALE = np.float32(1 / 32768.0)  # Scale of PCM16 samples to float32 in [-1, 1]
+
+
+def pcm16_to_float32(samples, out):
+    """
+    Convert PCM16 samples to float32 in [-1, 1], writing into a preallocated array.
+
+    Args:
+        samples (np.ndarray): int16 samples.
+        out (np.ndarray): float32 array of the same length receiving the converted samples.
+    """
+    out[:] = samples  # Casts in place without a temporary array
+    out *= PCM16_SCALE
+
+
+class AudioRingBuffer:
+    """
+    Preallocated ring buffer of float32 audio fed with PCM16 frames, e.g. streamed from the browser.
+
+    Frames are converted to float32 straight into the buffer, so no intermediate bytes or arrays are built. The
+    reader gets a float32 view of the unread audio to pass to Whisper, and releases it with consume() once done.
+    Unread audio is never overwritten: when the buffer is full, incoming samples are dropped and counted instead.
+    """
+
+    def __init__(self, seconds=60, sample_rate=SAMPLE_RATE):
+        """
+        Initialize the ring buffer.
+
+        Args:
+            seconds (float): Capacity of the buffer in seconds of audio.
+            sample_rate (int): Sample rate of the audio.
+        """
+        self.capacity = int(seconds * sample_rate)
+        self.buffer = np.zeros(self.capacity, dtype=np.float32)
+        self.scratch = np.zeros(self.capacity, dtype=np.float32)  # Contiguous copy of unread audio that wraps around
+        self.read_position = 0  # Total samples consumed
+        self.write_position = 0  # Total samples written
+        self.dropped = 0  # Samples dropped because the buffer was full
+        self.condition = threading.Condition()
+        self.on_write = None  # Function called after each write, e.g. to wake an asyncio reader
+
+    def available(self):
+        """
+        Get the number of unread samples. Must be called with the condition held.
+        """
+        return self.write_position - self.read_position
+
+    def unread(self):
+        """
+        Get the number of samples written but not consumed yet.
+
+        Returns:
+            int: Number of unread samples.
+        """
+        with self.condition:
+            return self.available()
+
+    def write(self, data):
+        """
+        Append a frame of PCM16 audio.
+
+        Args:
+            data (bytes): Little-endian PCM16 mono samples.
+        """
+        samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 2)
+        with self.condition:
+            free = self.capacity - self.available()
+            if len(samples) > free:
+                self.dropped += len(samples) - free
+                samples = samples[:free]
+            start = self.write_position % self.capacity
+            first = min(len(samples), self.capacity - start)
+            pcm16_to_float32(samples[:first], self.buffer[start:start + first])
+            pcm16_to_float32(samples[first:], self.buffer[:len(samples) - first])
+            self.write_position += len(samples)
+            self.condition.notify()
+        if self.on_write is not None:
+            self.on_write()
+
+    def read(self, min_samples=1, timeout=None):
+        """
+        Wait for unread audio and get all of it, without consuming it.
+
+        Args:
+            min_samples (int): Minimum number of unread samples to wait for.
+            timeout (float): Maximum time to wait in seconds.
+
+        Returns:
+            np.ndarray: float32 view of the unread audio, valid until consume() is called, or None on timeout.
+        """
+        with self.condition:
+            min_samples = min(min_samples, self.capacity)
+            if not self.condition.wait_for(lambda: self.available() >= min_samples, timeout):
+                return None
+            count = self.available()
+            start = self.read_position % self.capacity
+            if start + count <= self.capacity:
+                return self.buffer[start:start + count]
+            first = self.capacity - start
+            self.scratch[:first] = self.buffer[start:]
+            self.scratch[first:count] = self.buffer[:count - first]
+            return self.scratch[:count]
+
+    def consume(self, count):
+        """
+        Release samples returned by read() so they can be overwritten.
+
+        Args:
+            count (int): Number of samples to release.
+        """
+        with self.condition:
+            self.read_position += min(count, self.available())
+
+    def clear(self):
+        """
+        Discard all unread audio.
+        """
+        with self.condition:
+            self.read_position = self.write_position
+
+
+class AudioAccumulator:
+    """
+    Reusable float32 buffer collecting the PCM16 chunks waiting in an audio queue.
+
+    Replaces joining the chunks into one bytes object and converting it with astype and a division, which copied
+    the audio three times per chunk. Each chunk is converted straight into the buffer, which is only reallocated
+    when a backlog is larger than any seen before.
+    """
+
+    def __init__(self, seconds=30, sample_rate=SAMPLE_RATE):
+        """
+        Initialize the accumulator.
+
+        Args:
+            seconds (float): Initial capacity of the buffer in seconds of audio.
+            sample_rate (int): Sample rate of the audio.
+        """
+        self.buffer = np.zeros(int(seconds * sample_rate), dtype=np.float32)
+
+    def append(self, data, length):
+        """
+        Convert a PCM16 chunk into the buffer after the first length samples, growing the buffer if needed.
+
+        Args:
+            data (bytes): Little-endian PCM16 mono samples.
+            length (int): Number of samples already in the buffer.
+
+        Returns:
+            int: Number of samples in the buffer after appending.
+        """
+        samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 2)
+        end = length + len(samples)
+        if end > len(self.buffer):
+            grown = np.zeros(max(end, 2 * len(self.buffer)), dtype=np.float32)
+            grown[:length] = self.buffer[:length]
+            self.buffer = grown
+        pcm16_to_float32(samples, self.buffer[length:end])
+        return end
+
+    def drain(self, audio_queue, timeout=None):
+        """
+        Take every chunk waiting in the queue and convert them into the buffer.
+
+        Chunks are taken with the queue's own locking, so chunks put while draining are never lost.
+
+        Args:
+            audio_queue (queue.Queue): Queue of PCM16 bytes chunks.
+            timeout (float): Seconds to block waiting for the first chunk, or None to return immediately.
+
+        Returns:
+            np.ndarray: float32 view of the drained audio, valid until the next drain, or None if no audio arrived.
+        """
+        try:
+            data = audio_queue.get_nowait() if timeout is None else audio_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        length = self.append(data, 0)
+        while True:
+            try:
+                data = audio_queue.get_nowait()
+            except queue.Empty:
+                break
+            length = self.append(data, length)
+        return self.buffer[:length]
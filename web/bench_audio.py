@@ -0,0 +1,80 @@
+"""
+Benchmark of draining the audio queue: the old bytes join + astype/divide against AudioAccumulator.
+
+Simulates a long session of 2-second chunks at 16 kHz. Every few drains a backlog builds up (as happens while
+Whisper is busy), so several chunks are drained at once. Reports the time per drain and the memory allocated per
+drain for both approaches.
+
+Usage:
+    python bench_audio.py [--drains 2000] [--chunk-seconds 2] [--max-backlog 4]
+"""
+import argparse
+import time
+import tracemalloc
+from queue import Queue
+
+import numpy as np
+
+from audio import AudioAccumulator, SAMPLE_RATE
+
+
+def legacy_drain(audio_queue):
+    """
+    Drain the queue the way Lumino.speech_recognition used to.
+    """
+    audio_data = b''.join(list(audio_queue.queue))
+    audio_queue.queue.clear()
+    return np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def run(drain, chunks, backlogs):
+    """
+    Time every drain of a simulated session and measure the memory allocated by each.
+
+    Args:
+        drain (callable): Function draining the queue into a float32 array.
+        chunks (list): PCM16 chunks to feed.
+        backlogs (list): Number of chunks waiting in the queue at each drain.
+
+    Returns:
+        tuple: Drain times in milliseconds and peak allocated bytes per drain.
+    """
+    audio_queue = Queue()
+    times, peaks = [], []
+    for i, backlog in enumerate(backlogs):
+        for j in range(backlog):
+            audio_queue.put(chunks[(i + j) % len(chunks)])
+        tracemalloc.start()
+        start = time.perf_counter()
+        audio = drain(audio_queue)
+        times.append((time.perf_counter() - start) * 1000)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert audio is not None and len(audio) == backlog * len(chunks[0]) // 2
+    return np.array(times), np.array(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drains', type=int, default=2000, help='number of drains in the simulated session')
+    parser.add_argument('--chunk-seconds', type=float, default=2.0, help='length of each captured chunk')
+    parser.add_argument('--max-backlog', type=int, default=4, help='largest number of chunks drained at once')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    chunk_samples = int(args.chunk_seconds * SAMPLE_RATE)
+    chunks = [rng.integers(-32768, 32767, chunk_samples, dtype=np.int16).tobytes() for _ in range(8)]
+    backlogs = rng.integers(1, args.max_backlog + 1, args.drains)
+
+    accumulator = AudioAccumulator()
+    print(f"{args.drains} drains of 1-{args.max_backlog} x {args.chunk_seconds:g}s chunks "
+          f"({backlogs.sum() * args.chunk_seconds / 3600:.1f} hours of audio)")
+    print(f"{'method':<12}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}{'alloc/drain':>14}")
+    for name, drain in (('legacy', legacy_drain), ('accumulator', accumulator.drain)):
+        times, peaks = run(drain, chunks, backlogs)
+        print(f"{name:<12}{np.percentile(times, 50):>10.3f}{np.percentile(times, 95):>10.3f}"
+              f"{times.sum() / 1000:>10.2f}{np.mean(peaks) / 1024:>11.1f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,451 @@
+"""
+Offline replay benchmark of the full speech -> translation -> context path.
+
+WAV files are streamed through the same RecognitionPipeline the server uses, as if they came from a browser, either
+in real time or as fast as the pipeline consumes them. DeepL and Gemini are replaced by local stand-ins with a
+configurable latency, so runs are repeatable on a plain CPU box without network access or API quota.
+
+Each inference profile given is benchmarked in turn. Reports per-stage latency percentiles, the Whisper real-time
+factor, time to first text / translation / context and memory growth per profile. If a recording has a reference
+transcript next to it (recording.txt for recording.wav), the word error rate of the recognized text is reported too,
+counting each Chinese character as a word.
+
+Usage:
+    python benchmark.py recording.wav [more.wav ...] [--profile low-latency accuracy] [--model small] [--threads 4]
+                        [--realtime] [--translation-latency 0.15] [--context-latency 0.8] [--json results.json]
+    python benchmark.py --check-cache
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import threading
+import time
+import wave
+
+import numpy as np
+
+from audio import SAMPLE_RATE
+from cache import TranslationCache
+from inference import DEFAULT_PROFILE, PROFILES, InferenceScheduler
+from lumino import Lumino
+from pipeline import RecognitionPipeline
+from translation import IncrementalTranslator, TranslationBackend, TranslationClient
+
+FRAME_SAMPLES = 1600  # 100 ms frames, as streamed by the browser
+
+# Words of a transcript for the word error rate: CJK characters on their own, other words between spaces
+TRANSCRIPT_WORD = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff]|[^\W_㐀-䶿一-鿿]+(?:'[^\W_㐀-䶿一-鿿]+)*")
+
+
+class StubTranslationBackend(TranslationBackend):
+    """
+    Local stand-in for a translation service that answers after a fixed latency.
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency=0.15):
+        """
+        Args:
+            latency (float): Seconds each request takes.
+        """
+        self.latency = latency
+
+    def translate_batch(self, texts, source, target, context=None, formality=None):
+        time.sleep(self.latency)
+        return [f"[{target}] {text}" for text in texts]
+
+
+class StubResponse:
+    """
+    Response of the stub LLM, with the same text attribute as a Gemini response.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+
+class StubGenerativeModel:
+    """
+    Local stand-in for the Gemini model that answers after a fixed latency.
+    """
+
+    def __init__(self, latency=0.8):
+        """
+        Args:
+            latency (float): Seconds each request takes.
+        """
+        self.latency = latency
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        words = f"Context for {len(prompt)} characters of prompt".split(' ')
+        if not stream:
+            time.sleep(self.latency)
+            return StubResponse(' '.join(words))
+        return self.stream(words)
+
+    def stream(self, words):
+        """
+        Stream the response a word at a time, spreading the latency over the words.
+        """
+        for i, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            yield StubResponse(word if i == 0 else f" {word}")
+
+
+def load_wav(path):
+    """
+    Load a PCM16 WAV file as 16 kHz mono PCM16 samples.
+
+    Args:
+        path (str): Path of the WAV file.
+
+    Returns:
+        np.ndarray: int16 samples at 16 kHz.
+    """
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: only 16-bit PCM WAV files are supported")
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        channels, rate = wav.getnchannels(), wav.getframerate()
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE:
+        positions = np.arange(0, len(samples), rate / SAMPLE_RATE)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return samples.astype(np.int16)
+
+
+def transcript_words(text):
+    """
+    Split a transcript into lowercase words without punctuation.
+
+    Args:
+        text (str): English and/or Chinese text.
+
+    Returns:
+        list: The words, with each Chinese character as a word.
+    """
+    return TRANSCRIPT_WORD.findall(text.lower())
+
+
+def word_errors(reference, hypothesis):
+    """
+    Count the substitutions, deletions and insertions turning a reference transcript into a hypothesis.
+
+    Args:
+        reference (list): Words of the reference transcript.
+        hypothesis (list): Words of the recognized transcript.
+
+    Returns:
+        int: The word-level edit distance.
+    """
+    previous = list(range(len(hypothesis) + 1))
+    for i, word in enumerate(reference, 1):
+        current = [i]
+        for j, recognized in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (word != recognized)))
+        previous = current
+    return previous[-1]
+
+
+def load_reference(path):
+    """
+    Load the reference transcript of a recording, if there is one next to it.
+
+    Args:
+        path (str): Path of the WAV file.
+
+    Returns:
+        str: The reference transcript, or None.
+    """
+    reference = os.path.splitext(path)[0] + '.txt'
+    if not os.path.exists(reference):
+        return None
+    with open(reference, encoding='utf-8') as f:
+        return f.read()
+
+
+def rss_bytes():
+    """
+    Get the resident memory of this process.
+
+    Returns:
+        int: Resident set size in bytes.
+    """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentiles(values):
+    """
+    Summarize latencies in seconds.
+
+    Returns:
+        dict: Count and p50/p90/p99/max in milliseconds.
+    """
+    if not values:
+        return {'count': 0}
+    values = np.array(values) * 1000
+    return {'count': len(values), 'p50_ms': float(np.percentile(values, 50)), 'p90_ms': float(np.percentile(values, 90)),
+            'p99_ms': float(np.percentile(values, 99)), 'max_ms': float(values.max())}
+
+
+class Recorder:
+    """
+    Collect stage latencies and event times of a replay.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {'asr': [], 'translation': [], 'context_first_chunk': [], 'context': []}
+        self.audio_seconds = 0.0  # Seconds of audio transcribed by Whisper
+        self.asr_seconds = 0.0  # Seconds spent transcribing
+        self.first_event = {}  # Event name -> seconds after the replay started
+        self.lines = {}  # Line -> latest recognized text of the line in the current replay
+        self.start = None
+
+    def timed(self, stage, function):
+        """
+        Wrap a function so that each call's latency is recorded under a stage.
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.latencies[stage].append(time.perf_counter() - start)
+        return wrapper
+
+    def timed_stream(self, stage, function):
+        """
+        Wrap a generator function so that the time to its first item and to its end are recorded, under
+        stage + '_first_chunk' and stage.
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            first = True
+            try:
+                for item in function(*args, **kwargs):
+                    if first:
+                        first = False
+                        with self.lock:
+                            self.latencies[f'{stage}_first_chunk'].append(time.perf_counter() - start)
+                    yield item
+            finally:
+                with self.lock:
+                    self.latencies[stage].append(time.perf_counter() - start)
+        return wrapper
+
+    def timed_submit(self, submit):
+        """
+        Wrap InferenceScheduler.submit to record the latency and real-time factor of each transcription once its
+        future resolves.
+        """
+        def wrapper(audio, *args, **kwargs):
+            start = time.perf_counter()
+            future = submit(audio, *args, **kwargs)
+
+            def done(_):
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.latencies['asr'].append(elapsed)
+                    self.asr_seconds += elapsed
+                    self.audio_seconds += len(audio) / SAMPLE_RATE
+            future.add_done_callback(done)
+            return future
+        return wrapper
+
+    def emit(self, event, data):
+        """
+        Pipeline emit function recording when each kind of event first arrives and the recognized text of each line.
+        """
+        with self.lock:
+            self.first_event.setdefault(event, time.perf_counter() - self.start)
+            if event == 'recognition_result':
+                self.lines[data['line']] = data['recognized_text']
+
+    def transcript(self):
+        """
+        Get the text recognized in the current replay.
+        """
+        with self.lock:
+            return ' '.join(text for _, text in sorted(self.lines.items()))
+
+
+def replay(samples, lumino, realtime):
+    """
+    Stream samples into a Lumino instance as 100 ms browser frames.
+
+    In real time, frames are written at the pace they were recorded. Otherwise a frame is written as soon as the
+    pipeline has less than one recording chunk waiting, so it never idles and never builds a backlog.
+    """
+    chunk_samples = int(lumino.record_timeout * SAMPLE_RATE)
+    padded = np.concatenate([samples, np.zeros(chunk_samples, dtype=np.int16)])  # Flush the last partial chunk
+    start = time.perf_counter()
+    for offset in range(0, len(padded), FRAME_SAMPLES):
+        if realtime:
+            time.sleep(max(0.0, start + offset / SAMPLE_RATE - time.perf_counter()))
+        else:
+            while lumino.audio_buffer.unread() >= chunk_samples:
+                time.sleep(0.001)
+        lumino.audio_buffer.write(padded[offset:offset + FRAME_SAMPLES].tobytes())
+    while lumino.audio_buffer.unread() >= chunk_samples:
+        time.sleep(0.01)
+
+
+def run(paths, profile, model, threads, realtime, translation_latency, context_latency, settle):
+    """
+    Replay every file through the pipeline with an inference profile and collect the results.
+
+    Returns:
+        dict: Benchmark results.
+    """
+    rss_start = rss_bytes()
+    inference = InferenceScheduler(model, profile=profile, threads=threads)
+    inference.wait_until_ready()
+    recorder = Recorder()
+    inference.submit = recorder.timed_submit(inference.submit)
+    rss_loaded = rss_bytes()
+    translation_client = TranslationClient(StubTranslationBackend(translation_latency))  # No cache: every call is measured
+
+    replay_seconds = 0.0
+    errors = reference_words = 0
+    for path in paths:
+        samples = load_wav(path)
+        lumino = Lumino(inference)
+        lumino.set_capture_mode('browser')
+        lumino.translation_client = translation_client
+        lumino.model = StubGenerativeModel(context_latency)
+        lumino.memory.log = None  # Keep no transcripts of benchmark runs
+        lumino.translate_line = recorder.timed('translation', lumino.translate_line)
+        lumino.generate_context_stream = recorder.timed_stream('context', lumino.generate_context_stream)
+
+        pipeline = RecognitionPipeline(lumino, recorder.emit)
+        thread = threading.Thread(target=pipeline.run)
+        recorder.lines = {}
+        recorder.start = time.perf_counter()
+        thread.start()
+        replay(samples, lumino, realtime)
+        time.sleep(settle)  # Let translation and context catch up with the last chunk
+        lumino.stop_recognition()
+        thread.join()
+        replay_seconds += time.perf_counter() - recorder.start
+        print(f"{path}: {len(samples) / SAMPLE_RATE:.1f}s of audio replayed in {time.perf_counter() - recorder.start:.1f}s")
+        reference = load_reference(path)
+        if reference is not None:
+            words = transcript_words(reference)
+            errors += word_errors(words, transcript_words(recorder.transcript()))
+            reference_words += len(words)
+    inference.stop()
+
+    return {
+        'files': paths,
+        'profile': inference.profile,
+        'model': inference.model_name,
+        'threads': threads,
+        'mode': 'realtime' if realtime else 'max-speed',
+        'latency': {stage: percentiles(values) for stage, values in recorder.latencies.items()},
+        'whisper_rtf': recorder.asr_seconds / recorder.audio_seconds if recorder.audio_seconds else None,
+        'wer': errors / reference_words if reference_words else None,
+        'first_event_seconds': recorder.first_event,
+        'replay_seconds': replay_seconds,
+        'memory_mb': {
+            'model_loaded': (rss_loaded - rss_start) / 2 ** 20,
+            'growth_during_replay': (rss_bytes() - rss_loaded) / 2 ** 20,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+    }
+
+
+def check_phrase_cache(phrase="Thank you.", repeats=3):
+    """
+    Check that a stock phrase said as a line of its own is translated once and then answered from memory, as the
+    translations of recognized lines are.
+
+    Raises:
+        RuntimeError: If the repeated phrase was not answered from the memory cache.
+    """
+    cache = TranslationCache(path=None)
+    translator = IncrementalTranslator(TranslationClient(StubTranslationBackend(latency=0), cache).translate_batch)
+    for _ in range(repeats):
+        translator.update(phrase, source='EN', target='ZH-HANS')
+    stats = cache.stats()
+    print(f"Translation cache: {stats['memory_hits']} memory hits, {stats['misses']} misses for {repeats} lines "
+          f"of '{phrase}'")
+    if stats['misses'] != 1 or stats['memory_hits'] != repeats - 1:
+        raise RuntimeError(f"Repeated phrase '{phrase}' was not answered from the translation cache")
+
+
+def report(results):
+    """
+    Print the results as a table.
+    """
+    print(f"\nProfile {results['profile']} (Whisper {results['model']}), {results['mode']}")
+    print(f"{'stage':<21}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, summary in results['latency'].items():
+        if summary['count']:
+            print(f"{stage:<21}{summary['count']:>7}{summary['p50_ms']:>10.1f}{summary['p90_ms']:>10.1f}"
+                  f"{summary['p99_ms']:>10.1f}{summary['max_ms']:>10.1f}")
+    if results['whisper_rtf'] is not None:
+        print(f"Whisper real-time factor: {results['whisper_rtf']:.3f}")
+    if results['wer'] is not None:
+        print(f"Word error rate: {results['wer']:.1%}")
+    for event, seconds in results['first_event_seconds'].items():
+        print(f"First {event}: {seconds:.2f}s")
+    memory = results['memory_mb']
+    print(f"Memory: model {memory['model_loaded']:.0f} MB, growth during replay {memory['growth_during_replay']:.1f} MB, "
+          f"peak RSS {memory['peak_rss']:.0f} MB")
+
+
+def compare(all_results):
+    """
+    Print the real-time factor and word error rate of each profile side by side.
+    """
+    print(f"\n{'profile':<14}{'model':<8}{'RTF':>8}{'WER':>8}")
+    for results in all_results:
+        rtf = f"{results['whisper_rtf']:.3f}" if results['whisper_rtf'] is not None else '-'
+        wer = f"{results['wer']:.1%}" if results['wer'] is not None else '-'
+        print(f"{results['profile']:<14}{results['model']:<8}{rtf:>8}{wer:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('wav', nargs='*', help='16-bit PCM WAV files to replay')
+    parser.add_argument('--profile', nargs='+', default=[DEFAULT_PROFILE], choices=list(PROFILES),
+                        help='inference profiles to benchmark in turn')
+    parser.add_argument('--model', help='Whisper model name instead of the model of each profile')
+    parser.add_argument('--threads', type=int, help='torch CPU threads, instead of the torch default')
+    parser.add_argument('--realtime', action='store_true', help='stream audio at recording speed instead of max speed')
+    parser.add_argument('--translation-latency', type=float, default=0.15, help='seconds per stub translation request')
+    parser.add_argument('--context-latency', type=float, default=0.8, help='seconds per stub context request')
+    parser.add_argument('--settle', type=float, default=3.0, help='seconds to wait after each file for the last results')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--check-cache', action='store_true',
+                        help='check that repeated phrases are answered from the translation cache')
+    args = parser.parse_args()
+    if args.check_cache:
+        check_phrase_cache()
+    if not args.wav:
+        if not args.check_cache:
+            parser.error('no WAV files to replay')
+        return
+
+    all_results = []
+    for profile in args.profile:
+        results = run(args.wav, profile, args.model, args.threads, args.realtime, args.translation_latency,
+                      args.context_latency, args.settle)
+        report(results)
+        all_results.append(results)
+    if len(all_results) > 1:
+        compare(all_results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results if len(all_results) > 1 else all_results[0], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+
+# Default location of the persistent translation cache, next to this file unless overridden
+CACHE_PATH = os.getenv("LUMINO_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "translation_cache.sqlite3"))
+
+
+def normalize_text(text):
+    """
+    Normalize text so that trivially different spellings of a phrase share a cache entry.
+
+    Args:
+        text (str): Text to normalize.
+
+    Returns:
+        str: Text with Unicode compatibility forms folded, whitespace collapsed and case folded.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).split()).casefold()
+
+
+class TranslationCache:
+    """
+    Two-tier translation cache: a bounded in-memory LRU in front of a persistent SQLite store.
+
+    Entries are keyed by (normalized text, source, target, scenario, formality). Entries older than ttl seconds are
+    treated as missing, and the SQLite store is trimmed to max_disk_entries by evicting the least recently used rows.
+
+    Lookups never write to SQLite: new entries and the access times of disk hits are queued and written by a
+    background thread in one transaction every flush_interval seconds. The memory tier has its own lock, so memory
+    hits never wait for SQLite, and the database runs in WAL mode so reads do not wait for writes.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_memory_entries=2048, max_disk_entries=100000, ttl=30 * 24 * 3600,
+                 flush_interval=1.0):
+        """
+        Initialize the cache and create the SQLite table if needed.
+
+        Args:
+            path (str): Path of the SQLite database, or None to only cache in memory.
+            max_memory_entries (int): Maximum number of entries kept in memory.
+            max_disk_entries (int): Maximum number of entries kept on disk.
+            ttl (float): Seconds an entry stays valid, or None to never expire.
+            flush_interval (float): Seconds between writes of queued entries and access times to SQLite.
+        """
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.memory = OrderedDict()  # key -> (translation, created), least recently used first
+        self.lock = threading.Lock()  # Guards the memory tier, the counters and the write queues
+        self.db_lock = threading.Lock()  # Serializes use of the SQLite connection
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.puts_since_trim = 0
+        self.pending_puts = {}  # key -> (translation, created) of entries not written to SQLite yet
+        self.pending_accesses = {}  # key -> last access time of disk hits not written to SQLite yet
+        self.flush_requested = threading.Event()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS translations (
+                                   text TEXT, source TEXT, target TEXT, scenario TEXT, formality TEXT,
+                                   translation TEXT, created REAL, accessed REAL,
+                                   PRIMARY KEY (text, source, target, scenario, formality))""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS translations_accessed ON translations (accessed)")
+            self.db.commit()
+            self.writer = threading.Thread(target=self.write_behind, name="translation-cache-writer", daemon=True)
+            self.writer.start()
+
+    @staticmethod
+    def make_key(text, source, target, scenario='', formality=''):
+        """
+        Build the cache key for a translation request.
+
+        Returns:
+            tuple: (normalized text, source, target, scenario, formality).
+        """
+        return normalize_text(text), source or '', target or '', scenario or '', formality or ''
+
+    def expired(self, created, now):
+        """
+        Check whether an entry created at the given time has outlived the TTL.
+        """
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, text, source, target, scenario='', formality='', count_miss=True, disk=True):
+        """
+        Look up a cached translation.
+
+        Args:
+            text (str): Text to translate.
+            source (str): Source language code.
+            target (str): Target language code.
+            scenario (str): Scenario the translation was made for.
+            formality (str): Formality the translation was made with.
+            count_miss (bool): Whether to count a miss, False when the text is looked up again under another key.
+            disk (bool): Whether to look in SQLite after a memory miss. Memory lookups never block on SQLite, so
+                async callers look in memory first and only send the misses to a worker thread.
+
+        Returns:
+            str: The cached translation, or None on a miss.
+        """
+        key = self.make_key(text, source, target, scenario, formality)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key) or self.pending_puts.get(key)
+            if entry is not None and not self.expired(entry[1], now):
+                self.remember(key, *entry)
+                self.memory_hits += 1
+                CACHE_LOOKUPS.labels('memory_hit').inc()
+                return entry[0]
+            self.memory.pop(key, None)
+            if not disk:
+                return None  # Not counted: the caller looks the text up on disk next
+
+        row = None
+        if self.db is not None:
+            with self.db_lock:
+                if self.db is not None:
+                    row = self.db.execute("SELECT translation, created FROM translations WHERE text=? AND source=? "
+                                          "AND target=? AND scenario=? AND formality=?", key).fetchone()
+        with self.lock:
+            if row is not None and not self.expired(row[1], now):
+                self.remember(key, row[0], row[1])
+                self.pending_accesses[key] = now  # Written with the next flush, not on the lookup path
+                self.disk_hits += 1
+                CACHE_LOOKUPS.labels('disk_hit').inc()
+                return row[0]
+            if count_miss:
+                self.misses += 1
+                CACHE_LOOKUPS.labels('miss').inc()
+            return None
+
+    def put(self, text, source, target, scenario='', formality='', translation=''):
+        """
+        Store a translation in memory and queue it to be written to SQLite.
+
+        Args:
+            text (str): Text that was translated.
+            source (str): Source language code.
+            target (str): Target language code.
+            scenario (str): Scenario the translation was made for.
+            formality (str): Formality the translation was made with.
+            translation (str): The translation.
+        """
+        key = self.make_key(text, source, target, scenario, formality)
+        now = time.time()
+        with self.lock:
+            self.remember(key, translation, now)
+            if self.db is not None:
+                self.pending_puts[key] = (translation, now)
+                if len(self.pending_puts) >= 100:
+                    self.flush_requested.set()
+
+    def write_behind(self):
+        """
+        Write queued entries and access times to SQLite every flush_interval seconds, until the cache is closed.
+        """
+        while self.db is not None:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write the queued entries and access times to SQLite in one transaction.
+        """
+        with self.lock:
+            puts, self.pending_puts = self.pending_puts, {}
+            accesses, self.pending_accesses = self.pending_accesses, {}
+        if not puts and not accesses:
+            return
+        with self.db_lock:
+            if self.db is None:
+                return
+            self.db.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(*key, translation, created, created) for key, (translation, created) in puts.items()])
+            self.db.executemany("UPDATE translations SET accessed=? WHERE text=? AND source=? AND target=? AND "
+                                "scenario=? AND formality=?", [(accessed, *key) for key, accessed in accesses.items()])
+            self.puts_since_trim += len(puts)
+            if self.puts_since_trim >= 100:
+                self.trim(time.time())
+            self.db.commit()
+
+    def remember(self, key, translation, created):
+        """
+        Add an entry to the in-memory LRU, evicting the least recently used entry if it is full.
+        """
+        self.memory[key] = (translation, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def trim(self, now):
+        """
+        Remove expired rows and the least recently used rows beyond max_disk_entries from the SQLite store.
+        """
+        self.puts_since_trim = 0
+        if self.ttl is not None:
+            self.db.execute("DELETE FROM translations WHERE created < ?", (now - self.ttl,))
+        self.db.execute("DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations ORDER BY accessed DESC "
+                        "LIMIT -1 OFFSET ?)", (self.max_disk_entries,))
+
+    def stats(self):
+        """
+        Get the hit and miss counters of the cache.
+
+        Returns:
+            dict: Memory hits, disk hits, misses and the number of entries held in memory.
+        """
+        with self.lock:
+            return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'memory_entries': len(self.memory)}
+
+    def close(self):
+        """
+        Write the queued entries and close the SQLite store.
+        """
+        self.flush()
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+        self.flush_requested.set()
+
+
+shared_cache = None  # Process-wide cache shared by all sessions
+shared_cache_lock = threading.Lock()
+
+
+def get_translation_cache():
+    """
+    Get the process-wide translation cache, creating it on first use.
+
+    Returns:
+        TranslationCache: The shared cache.
+    """
+    global shared_cache
+    with shared_cache_lock:
+        if shared_cache is None:
+            shared_cache = TranslationCache()
+        return shared_cache
@@ -0,0 +1,172 @@
+import threading
+import time
+
+from metrics import SOCKET_PAYLOAD_BYTES
+
+# Events of the recognition pipelines that carry the full text of a field of a line, and that field
+LINE_FIELDS = {
+    'recognition_result': 'recognized_text',
+    'translation_result': 'translated_text',
+    'context_result': 'generated_context',
+}
+
+
+def utf16_length(text):
+    """
+    Get the length of a text in UTF-16 code units, the unit of JavaScript string offsets.
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def common_prefix_length(a, b):
+    """
+    Get the number of leading characters two texts have in common.
+    """
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class DeltaEncoder:
+    """
+    Compact update protocol between the recognition pipeline of a client and its browser.
+
+    The pipelines emit the full recognized text, translation and context of a line on every chunk. The encoder keeps
+    the text last sent for each field of each recent line and sends only what changed, as a patch [offset, text]:
+    the client keeps the first offset characters (UTF-16 code units) of the field and appends text. Recognized text
+    only grows and translations of a line mostly change in their last sentence, so patches stay small however long
+    the line gets.
+
+    Every update carries a sequence number. A snapshot of the full text of the recent lines is sent every
+    snapshot_interval updates or snapshot_seconds, and on request, so a client that missed an update, e.g. after
+    reconnecting, resynchronizes. Updates can be encoded with msgpack, sent as binary socket messages.
+
+    Other events are passed through unchanged.
+    """
+
+    def __init__(self, send, binary=False, snapshot_interval=100, snapshot_seconds=30.0, max_lines=20):
+        """
+        Initialize the encoder.
+
+        Args:
+            send (callable): Function called as send(event, data) to deliver a message to the client.
+            binary (bool): Whether to encode updates and snapshots with msgpack.
+            snapshot_interval (int): Updates after which a snapshot is sent.
+            snapshot_seconds (float): Seconds after which a snapshot is sent with the next update.
+            max_lines (int): Most recent lines whose text is kept and included in snapshots.
+        """
+        self.send = send
+        self.binary = binary
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_seconds = snapshot_seconds
+        self.max_lines = max_lines
+        self.seq = 0  # Sequence number of the last message sent
+        self.lines = {}  # Line -> field -> text last sent, oldest line first
+        self.streams = {}  # Line -> (stream number, text streamed so far) of its context stream
+        self.updates_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        self.lock = threading.Lock()  # Orders messages emitted by the pipeline stages of a client
+
+    def emit(self, event, data):
+        """
+        Deliver a pipeline event to the client, as a patch if it updates the text of a line.
+
+        Args:
+            event (str): Name of the event.
+            data (dict): Data of the event.
+        """
+        if event == 'context_chunk':
+            with self.lock:
+                stream, text = self.streams.get(data['line'], (None, ''))
+                text = text + data['delta'] if stream == data['stream'] else data['delta']
+                self.streams[data['line']] = (data['stream'], text)
+                self.update(data['line'], 'generated_context', text)
+        elif event in LINE_FIELDS:
+            with self.lock:
+                if event == 'context_result':
+                    self.streams.pop(data['line'], None)
+                self.update(data['line'], LINE_FIELDS[event], data[LINE_FIELDS[event]],
+                            language=data.get('language'), new=data.get('is_new_line', False))
+        else:
+            self.send(event, data)
+
+    def update(self, line, field, text, language=None, new=False):
+        """
+        Send a patch of a field of a line. Called with the lock held.
+
+        Args:
+            line (int): Index of the line.
+            field (str): Name of the field.
+            text (str): Full new text of the field.
+            language (str): Spoken language of the line, sent with the first text of a new line.
+            new (bool): Whether this is the first text of a new line, e.g. a line index reused after clearing.
+        """
+        if new:
+            self.lines.pop(line, None)
+        fields = self.lines.get(line)
+        if fields is None:
+            fields = self.lines[line] = {}
+            while len(self.lines) > self.max_lines:
+                oldest = next(iter(self.lines))
+                del self.lines[oldest]
+                self.streams.pop(oldest, None)
+        sent = fields.get(field, '')
+        if text == sent and not new:
+            return
+        offset = common_prefix_length(sent, text)
+        fields[field] = text
+        message = {'seq': self.next_seq(), 'line': line, 'field': field,
+                   'patch': [utf16_length(text[:offset]), text[offset:]]}
+        if new:
+            message['new'] = True
+            message['language'] = fields['language'] = language
+        self.deliver('line_update', message)
+        self.updates_since_snapshot += 1
+        if (self.updates_since_snapshot >= self.snapshot_interval or
+                time.monotonic() - self.last_snapshot >= self.snapshot_seconds):
+            self.send_snapshot()
+
+    def reset(self):
+        """
+        Forget the text sent for every line, e.g. when the conversation is cleared or recognition restarts, so
+        snapshots do not bring back lines of an earlier conversation.
+        """
+        with self.lock:
+            self.lines.clear()
+            self.streams.clear()
+
+    def snapshot(self):
+        """
+        Send a snapshot of the recent lines, e.g. when the client asks to resynchronize.
+        """
+        with self.lock:
+            self.send_snapshot()
+
+    def send_snapshot(self):
+        """
+        Send a snapshot of the recent lines. Called with the lock held.
+        """
+        lines = [{'line': line, **fields} for line, fields in self.lines.items()]
+        self.deliver('line_snapshot', {'seq': self.next_seq(), 'lines': lines})
+        self.updates_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def deliver(self, event, message):
+        """
+        Encode a message and send it. The size of binary messages is counted from the encoded frame; JSON messages
+        are encoded by Socket.IO and not counted, so they are not serialized twice.
+        """
+        if self.binary:
+            import msgpack
+
+            payload = msgpack.packb(message)
+            SOCKET_PAYLOAD_BYTES.labels(event).inc(len(payload))
+        else:
+            payload = message
+        self.send(event, payload)
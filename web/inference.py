@@ -0,0 +1,370 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from audio import SAMPLE_RATE
+
+# Inference profiles by name: the Whisper model, its beam size (None for greedy decoding), whether its linear
+# layers are quantized to int8 when running on the CPU and whether chunks are decoded with the previous text as prompt.
+# Every profile decodes greedily, as before profiles existed. Prompts let short chunks be decoded with the sentence
+# they continue; tiny tends to repeat its prompt back, so the fastest profile decodes without one.
+PROFILES = {
+    'fastest': {'model': 'tiny', 'beam_size': None, 'quantize': True, 'prompt': False},
+    'low-latency': {'model': 'base', 'beam_size': None, 'quantize': True, 'prompt': True},
+    'accuracy': {'model': 'small', 'beam_size': None, 'quantize': False, 'prompt': True},
+}
+
+# Profile used unless another is given, e.g. LUMINO_INFERENCE_PROFILE=low-latency on CPU-only servers
+DEFAULT_PROFILE = os.getenv("LUMINO_INFERENCE_PROFILE", "accuracy")
+
+# Torch CPU threads used for inference, or unset to keep the torch default of one per physical core
+WHISPER_THREADS = int(os.getenv("LUMINO_WHISPER_THREADS", "0")) or None
+
+
+def quantize_linear_layers(model):
+    """
+    Quantize the linear layers of a Whisper model to int8 with dynamic quantization, for faster CPU inference.
+
+    Whisper's linear layers subclass torch.nn.Linear, which dynamic quantization does not convert, so they are
+    replaced by plain ones holding the same weights first.
+
+    Args:
+        model (whisper.Whisper): Model on the CPU, quantized in place.
+
+    Returns:
+        whisper.Whisper: The quantized model.
+    """
+    import torch
+
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+                linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                linear.load_state_dict(child.state_dict())
+                setattr(module, name, linear)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class TranscriptionRequest:
+    """
+    A chunk of audio waiting to be transcribed, with the future that receives its result.
+    """
+
+    def __init__(self, audio, language=None, languages=None, prompt=None):
+        self.audio = audio  # float32 samples in [-1, 1] at 16 kHz
+        self.language = language  # Language to decode in, or None to detect it
+        self.languages = languages  # Languages detection may choose from, or None for any
+        self.prompt = prompt  # Previously transcribed text the decoding continues from, if any
+        self.mel = None  # Log-Mel spectrogram, kept when computed for language detection
+        self.future = Future()
+
+
+class InferenceScheduler:
+    """
+    Share one Whisper model between all sessions and batch their transcriptions.
+
+    The model is loaded and warmed up in the background, so creating the scheduler returns immediately; torch and
+    whisper are only imported there. Chunks submitted before the model is ready wait in the queue.
+
+    Chunks submitted by concurrent sessions are collected for up to batch_window seconds and decoded together as a
+    single padded batch of 30-second log-Mel spectrograms, grouped by decoding language. Chunks longer than 30
+    seconds cannot be padded into a batch and are transcribed on their own.
+
+    A chunk can restrict language detection to a set of languages, e.g. the two languages of a conversation. Its
+    language is then detected in a separate batched pass and it is decoded in the most likely allowed language.
+
+    A chunk can also carry the text transcribed before it as a prompt, so a short chunk is decoded with the context
+    of the sentence it continues, if the profile enables prompts. Whisper takes one prompt per batch, so batches are
+    still grouped by language only, and the prompt is used only when every chunk of a batch has the same one, e.g. a
+    batch of a single chunk. Chunks of other sessions in the batch would otherwise be conditioned on a prompt that
+    is not theirs.
+
+    The model size, decoding and CPU optimizations are chosen by an inference profile, see PROFILES.
+    """
+
+    def __init__(self, model_name=None, max_batch=8, batch_window=0.05, profile=None, threads=WHISPER_THREADS):
+        """
+        Start loading the Whisper model in the scheduler thread.
+
+        Args:
+            model_name (str): Name of the Whisper model to load, instead of the model of the profile.
+            max_batch (int): Maximum number of chunks decoded together.
+            batch_window (float): Seconds to wait for more chunks after the first one arrives.
+            profile (str): Name of the inference profile, see PROFILES. Defaults to DEFAULT_PROFILE.
+            threads (int): Torch CPU threads to use for inference, or None to keep the torch default.
+        """
+        self.profile = profile or DEFAULT_PROFILE
+        if self.profile not in PROFILES:
+            raise ValueError(f"Unknown inference profile '{self.profile}', choose from {', '.join(PROFILES)}")
+        settings = PROFILES[self.profile]
+        self.model_name = model_name or settings['model']
+        self.beam_size = settings['beam_size']
+        self.quantize = settings['quantize']
+        self.use_prompt = settings['prompt']
+        self.threads = threads
+        self.model = None  # Loaded in the scheduler thread
+        self.max_samples = None
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.fp16 = False
+        self.ready = threading.Event()  # Set once loading has finished, whether or not the model loaded
+        self.load_error = None  # Exception raised while loading the model, if any
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="whisper-scheduler", daemon=True)
+        self.thread.start()
+
+    def load(self):
+        """
+        Load the Whisper model and run a warm-up inference on a second of silence, so the first real chunk does not
+        pay for lazy initialization.
+        """
+        import torch
+        import whisper
+
+        start = time.monotonic()
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.fp16 = torch.cuda.is_available()
+        self.model = whisper.load_model(self.model_name)  # Load Whisper speech recognition model
+        quantized = self.quantize and self.model.device.type == 'cpu'
+        if quantized:
+            self.model = quantize_linear_layers(self.model)
+        self.max_samples = whisper.audio.N_SAMPLES  # Longest chunk that fits in one 30-second window
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(np.zeros(SAMPLE_RATE, dtype=np.float32)),
+                                          n_mels=self.model.dims.n_mels).to(self.model.device)
+        whisper.decode(self.model, mel, self.decoding_options('en'))
+        print(f"Whisper model '{self.model_name}' ({self.profile}{', int8' if quantized else ''}, "
+              f"{torch.get_num_threads()} threads) ready in {time.monotonic() - start:.1f}s")
+
+    def decoding_options(self, language, prompt=None):
+        """
+        Get the Whisper decoding options of the profile.
+
+        Args:
+            language (str): Whisper language code, or None to detect it.
+            prompt (str): Previously transcribed text to condition the decoding on, if any.
+
+        Returns:
+            whisper.DecodingOptions: The decoding options.
+        """
+        import whisper
+
+        return whisper.DecodingOptions(language=language, fp16=self.fp16, beam_size=self.beam_size, prompt=prompt)
+
+    def is_ready(self):
+        """
+        Check whether the model is loaded and warmed up.
+
+        Returns:
+            bool: True once transcriptions can be served, False while loading and if the model failed to load.
+        """
+        return self.ready.is_set() and self.load_error is None
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Wait for the model to be loaded and warmed up.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+
+        Returns:
+            bool: True if the model is ready.
+
+        Raises:
+            RuntimeError: If the model failed to load.
+        """
+        self.ready.wait(timeout)
+        if self.load_error is not None:
+            raise RuntimeError(f"Whisper model failed to load: {self.load_error}")
+        return self.ready.is_set()
+
+    def submit(self, audio, language=None, languages=None, prompt=None, session=None):
+        """
+        Queue a chunk of audio for transcription.
+
+        Args:
+            audio (np.ndarray): float32 samples in [-1, 1] at 16 kHz.
+            language (str): Whisper language code to decode in, or None to detect it.
+            languages (tuple): Whisper language codes detection may choose from, or None for any language.
+            prompt (str): Text transcribed before the chunk, to condition the decoding on.
+            session (str): Session the chunk belongs to, for the interface of worker_pool.ProcessInferencePool.
+
+        Returns:
+            Future: Resolves to a dict with the transcribed 'text' and the decoded 'language'.
+        """
+        request = TranscriptionRequest(audio, language, languages, prompt)
+        self.requests.put(request)
+        return request.future
+
+    def transcribe(self, audio, language=None, languages=None, prompt=None, session=None):
+        """
+        Transcribe a chunk of audio, waiting for the batch it is decoded in.
+
+        Args:
+            audio (np.ndarray): float32 samples in [-1, 1] at 16 kHz.
+            language (str): Whisper language code to decode in, or None to detect it.
+            languages (tuple): Whisper language codes detection may choose from, or None for any language.
+            prompt (str): Text transcribed before the chunk, to condition the decoding on.
+            session (str): Session the chunk belongs to.
+
+        Returns:
+            dict: The transcribed 'text' and the decoded 'language'.
+        """
+        return self.submit(audio, language, languages, prompt, session).result()
+
+    def stop(self):
+        """
+        Stop the scheduler thread once the queued requests are done.
+        """
+        self.requests.put(None)
+
+    def next_batch(self):
+        """
+        Wait for a request, then collect more until the batch is full or the batch window has passed.
+
+        Returns:
+            list: The requests to decode together, or None if the scheduler was stopped.
+        """
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None)  # Stop after this batch
+                break
+            batch.append(request)
+        return batch
+
+    def run(self):
+        """
+        Load the model, then decode batches of requests until the scheduler is stopped.
+        """
+        try:
+            self.load()
+        except Exception as e:
+            print(f"Error loading Whisper model: {e}")
+            self.load_error = e
+        self.ready.set()
+
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            # Skip requests cancelled while they waited, e.g. by a session that stopped
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if self.load_error is not None:
+                for request in batch:
+                    request.future.set_exception(RuntimeError(f"Whisper model failed to load: {self.load_error}"))
+                continue
+            restricted = [request for request in batch if request.language is None and request.languages]
+            if restricted:
+                self.detect_languages(restricted)
+            groups = {}
+            for request in batch:
+                if request.future.done():
+                    continue  # Failed during language detection
+                if len(request.audio) > self.max_samples:
+                    self.decode_long(request)
+                else:
+                    groups.setdefault(request.language, []).append(request)
+            for language, group in groups.items():
+                self.decode_batch(group, language, self.batch_prompt(group))
+
+    def mel(self, request):
+        """
+        Get the log-Mel spectrogram of the first 30 seconds of a request, computing it once.
+
+        Args:
+            request (TranscriptionRequest): The request.
+
+        Returns:
+            torch.Tensor: The log-Mel spectrogram.
+        """
+        import whisper
+
+        if request.mel is None:
+            request.mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(request.audio), n_mels=self.model.dims.n_mels)
+        return request.mel
+
+    def detect_languages(self, requests):
+        """
+        Detect the language of requests in a single batched pass, choosing among each request's allowed languages.
+        The detected language is set as the request's decoding language.
+
+        Args:
+            requests (list): Requests without a decoding language and with allowed languages.
+        """
+        import torch
+
+        try:
+            mels = torch.stack([self.mel(request) for request in requests]).to(self.model.device)
+            _, probabilities = self.model.detect_language(mels)
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        for request, probs in zip(requests, probabilities):
+            request.language = max(request.languages, key=lambda language: probs.get(language, 0.0))
+
+    def batch_prompt(self, group):
+        """
+        Get the prompt a batch is decoded with.
+
+        Args:
+            group (list): Requests decoded together.
+
+        Returns:
+            str: The prompt shared by every request of the batch, or None if prompts are disabled or they differ.
+        """
+        prompts = {request.prompt for request in group}
+        return prompts.pop() if self.use_prompt and len(prompts) == 1 else None
+
+    def decode_batch(self, group, language, prompt=None):
+        """
+        Decode chunks of at most 30 seconds together as one padded batch.
+
+        Args:
+            group (list): Requests decoded in the same language.
+            language (str): Whisper language code, or None to detect it per chunk.
+            prompt (str): Previously transcribed text to condition the decoding on, if any.
+        """
+        import torch
+        import whisper
+
+        try:
+            mels = torch.stack([self.mel(request) for request in group]).to(self.model.device)
+            results = whisper.decode(self.model, mels, self.decoding_options(language, prompt))
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(group, results):
+            request.future.set_result({'text': result.text.strip(), 'language': result.language})
+
+    def decode_long(self, request):
+        """
+        Transcribe a chunk longer than 30 seconds on its own, letting Whisper split it into windows.
+
+        Args:
+            request (TranscriptionRequest): The request to transcribe.
+        """
+        try:
+            result = self.model.transcribe(request.audio, language=request.language, fp16=self.fp16,
+                                           beam_size=self.beam_size, initial_prompt=request.prompt if self.use_prompt else None)
+        except Exception as e:
+            request.future.set_exception(e)
+            return
+        request.future.set_result({'text': result['text'].strip(), 'language': result['language']})
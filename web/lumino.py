@@ -1,15 +1,51 @@
+import asyncio
 import time
 import os
-import torch
-import whisper
-import numpy as np
 import speech_recognition as sr
+from collections import OrderedDict
 from queue import Queue
-import deepl
-import google.generativeai as gem
-from deep_translator import GoogleTranslator
 from keys import GEMINI_API_KEY, DEEPL_API_KEY
+from translation import IncrementalTranslator, cacheable_count, get_translation_client
 import threading
+from inference import InferenceScheduler
+from audio import AudioAccumulator, AudioRingBuffer, SAMPLE_RATE
+from vad import VoiceActivityDetector
+from memory import SESSION_LOG_DIR, ConversationMemory, SessionLog
+from metrics import AUDIO_CHUNKS, DEQUEUED_AUDIO, STAGE_SECONDS, VAD_DROPPED, WHISPER_RTF, ChunkTrace
+
+# Scenarios and their descriptions used to generate context
+SCENARIOS = {
+    "General 通用": "This context refers to everyday, general conversations without specific focus that an elderly Chinese immigrant in Australia may have. It covers casual interactions that are not tied to any particular domain, such as greetings, basic questions, or social small talk. In this context, the conversation could involve a variety of topics ranging from weather, personal well-being, or simple inquiries. The goal is to keep the translation as neutral and everyday as possible, avoiding any specialized terminology.",
+    "Local Community 社区": "This context relates to conversations within the local community, such as interactions with family members, friends, neighbors, tradespeople, shop owners, cashiers, and other people you encounter regularly in your day-to-day life. This includes small transactions, informal exchanges, asking for help, or engaging with people in familiar settings. The language used here is more informal, reflecting the tone of a community that is close-knit and casual.",
+    "Social Services 社会服务": "This context involves conversations related to government services and welfare programs in Australia, such as Centrelink (financial assistance), Medicare (public healthcare), superannuation (retirement savings), pensions, taxes, and other services that assist in everyday living. It includes discussions about applying for benefits, understanding rights and entitlements, navigating bureaucracy, and engaging with service providers. The language should be clear, straightforward, and possibly include formal or legal terminology often used in public services.",
+    "Medical Services 医疗": "This context focuses on medical-related conversations, including interactions with healthcare professionals like general practitioners (GPs), hospitals, physiotherapists, pharmacists, and nurses. It covers discussions about appointments, medical treatments, prescriptions, health advice, and explanations of medical conditions. In this context, the language is both technical (with medical terminology) and conversational, reflecting the seriousness of healthcare while remaining accessible for patients, especially those unfamiliar with medical terms. Understanding the correct use of terminology is key to avoid confusion."
+}
+
+# Whisper language codes of the spoken languages
+WHISPER_LANGUAGES = {"EN": "en", "ZH": "zh"}
+
+
+generative_model = None  # Gemini model shared by all sessions
+generative_model_lock = threading.Lock()
+
+
+def get_generative_model():
+    """
+    Get the Gemini model shared by all sessions, importing and configuring google.generativeai on first use so
+    the import stays off the server start-up path.
+
+    Returns:
+        GenerativeModel: The shared model.
+    """
+    global generative_model
+    with generative_model_lock:
+        if generative_model is None:
+            import google.generativeai as gem
+
+            gem.configure(api_key=GEMINI_API_KEY)  # Configure generative AI API key
+            generative_model = gem.GenerativeModel("gemini-1.5-flash")  # Initialize generative AI model
+        return generative_model
+
 
 class Lumino:
     """
@@ -17,39 +53,60 @@ class Lumino:
     This class includes microphone initialization, audio processing, translation functionality, and generating conversation context.
     """
 
-    def __init__(self):
+    def __init__(self, inference=None):
         """
         Initialize an instance of the Lumino class, including setting language, context, microphone source, and speech recognition model.
+
+        Args:
+            inference (InferenceScheduler): Whisper model shared with other sessions. A new one is loaded if not given.
         """
         self.DEEPL_API_KEY = os.getenv("DEEPL_API_KEY")  # Get Deepl API key
+        self.session_id = None  # ID of the client session, used in traces
         self.spoken_language = "EN"  # Default spoken language
         self.target_language = "ZH"  # Default target language
-        # Scenarios and their descriptions used to generate context
-        self.scenarios = {
-            "General 通用": "This context refers to everyday, general conversations without specific focus that an elderly Chinese immigrant in Australia may have. It covers casual interactions that are not tied to any particular domain, such as greetings, basic questions, or social small talk. In this context, the conversation could involve a variety of topics ranging from weather, personal well-being, or simple inquiries. The goal is to keep the translation as neutral and everyday as possible, avoiding any specialized terminology.",
-            "Local Community 社区": "This context relates to conversations within the local community, such as interactions with family members, friends, neighbors, tradespeople, shop owners, cashiers, and other people you encounter regularly in your day-to-day life. This includes small transactions, informal exchanges, asking for help, or engaging with people in familiar settings. The language used here is more informal, reflecting the tone of a community that is close-knit and casual.",
-            "Social Services 社会服务": "This context involves conversations related to government services and welfare programs in Australia, such as Centrelink (financial assistance), Medicare (public healthcare), superannuation (retirement savings), pensions, taxes, and other services that assist in everyday living. It includes discussions about applying for benefits, understanding rights and entitlements, navigating bureaucracy, and engaging with service providers. The language should be clear, straightforward, and possibly include formal or legal terminology often used in public services.",
-            "Medical Services 医疗": "This context focuses on medical-related conversations, including interactions with healthcare professionals like general practitioners (GPs), hospitals, physiotherapists, pharmacists, and nurses. It covers discussions about appointments, medical treatments, prescriptions, health advice, and explanations of medical conditions. In this context, the language is both technical (with medical terminology) and conversational, reflecting the seriousness of healthcare while remaining accessible for patients, especially those unfamiliar with medical terms. Understanding the correct use of terminology is key to avoid confusion."
-        }
+        self.auto_language = False  # Detect the spoken language of each utterance instead of using spoken_language
+        self.utterance_language = None  # Language detected for the speech still going on, pinned until it pauses
+        self.on_language_change = None  # Called with the new spoken language when auto detection switches it
+        self.scenarios = SCENARIOS  # Scenarios and their descriptions used to generate context
         self.selected_scenario = "General 通用"  # Default scenario
-        self.line_time = None
+        self.line_time = None  # Time the current line last received speech
         self.audio_queue = Queue()  # Queue for storing audio data
+        self.audio_accumulator = AudioAccumulator()  # Reusable float32 buffer the queued audio is drained into
         self.recognizer = sr.Recognizer()  # Initialize speech recognizer
         self.recognizer.dynamic_energy_threshold = False  # Disable dynamic energy threshold
-        gem.configure(api_key=GEMINI_API_KEY)  # Configure generative AI API key
-        self.model = gem.GenerativeModel("gemini-1.5-flash")  # Initialize generative AI model
+        self.model = None  # Generative AI model, shared and configured on first use
         self.source = None  # Microphone source
-        self.audio_model = whisper.load_model("small")  # Load Whisper speech recognition model
+        self.capture_mode = 'server'  # 'server' microphone or audio streamed from the 'browser'
+        self.audio_buffer = AudioRingBuffer()  # Preallocated buffer receiving audio streamed from the browser
+        self.inference = inference or InferenceScheduler()  # Shared Whisper model, loaded in the background
         self.record_timeout = 2  # Recording timeout
+        self.prompt_chars = 200  # Characters of the previous text passed to Whisper as the decoding prompt
+        self.vad_enabled = True  # Skip silent chunks and trim silence before transcription
+        self.vad = VoiceActivityDetector()  # Voice activity gate in front of Whisper
         self.line_timeout = 3  # Line timeout
-        self.speech_text = ['']  # Store the entire conversation text
+        self.context_quiet_interval = 1.5  # Seconds without new speech before context is regenerated mid-sentence
+        self.speech_text = ['']  # Recent lines of the conversation, older lines are in memory
+        self.line_offset = 0  # Index of the first line still in speech_text
+        self.max_transcript_lines = 20  # Lines kept in speech_text
+        # Bounded memory used in context prompts, spilling folded turns to disk only if LUMINO_SESSION_LOG_DIR is set
+        self.memory = ConversationMemory(self.summarize, log=SessionLog() if SESSION_LOG_DIR else None)
+        self.line_language = None  # Spoken language of the current line, None until it has text
         self.spoken_line = ""  # Current spoken line
         self.stop_event = threading.Event()  # Event to stop speech recognition
         self.stop_listening = None  # Save the stop listening function
+        self.incremental_translation = True  # Only re-translate the unfinished sentence of a line
+        self.translation_backend = os.getenv('LUMINO_TRANSLATION_BACKEND', 'hedged')  # See translation.BACKENDS
+        self.translation_client = None  # Client used instead of the shared one of translation_backend, e.g. in benchmarks
+        self.translation_timeout = 5  # Seconds an async translation request may take
+        self.context_timeout = 15  # Seconds an async context request may take
+        # Keeps translations of committed sentences
+        # Committed translations of each recent line, so translations of different lines can run at the same time
+        self.line_translators = OrderedDict()  # Line -> IncrementalTranslator, most recently used last
+        self.max_line_translators = 4  # Lines whose committed translations are kept
 
     def translate(self, source='EN', target='ZH-HANS', text=''):
         """
-        Translate text using Deepl API.
+        Translate text using Deepl API, answering repeated phrases from the translation cache.
         
         Args:
             source (str): Source language code.
@@ -59,10 +116,131 @@ class Lumino:
         Returns:
             str: Translated text.
         """
-        translator = deepl.Translator(DEEPL_API_KEY)
-        formality = 'prefer_less' if self.get_context() not in ["Medical Services 医疗", "Social Services 社会服务"] else 'prefer_more'
-        return translator.translate_text(text=text, source_lang=source, target_lang=target,
-                                         context=self.get_scenarios()[self.get_context()], formality=formality).text
+        return self.translate_batch([text], source=source, target=target)[0]
+
+    def translate_batch(self, texts, source='EN', target='ZH-HANS', cacheable=None):
+        """
+        Translate several texts using Deepl API in a single request.
+
+        Args:
+            texts (list): Texts to be translated.
+            source (str): Source language code.
+            target (str): Target language code.
+            cacheable (int): Number of leading texts whose translations are cached, or None for all.
+
+        Returns:
+            list: Translated texts, in the same order.
+        """
+        client, options = self.translation_request()
+        return client.translate_batch(texts, source, target, cacheable=cacheable, **options)
+
+    async def translate_batch_async(self, texts, source='EN', target='ZH-HANS', cacheable=None):
+        """
+        Translate several texts in a single request without blocking the event loop, waiting at most
+        translation_timeout seconds.
+
+        Args:
+            texts (list): Texts to be translated.
+            source (str): Source language code.
+            target (str): Target language code.
+            cacheable (int): Number of leading texts whose translations are cached, or None for all.
+
+        Returns:
+            list: Translated texts, in the same order.
+        """
+        client, options = self.translation_request()
+        return await client.translate_batch_async(texts, source, target, timeout=self.translation_timeout,
+                                                  cacheable=cacheable, **options)
+
+    def translation_request(self):
+        """
+        Get the translation client and the scenario options of a translation request.
+
+        Returns:
+            tuple: The TranslationClient and the context, scenario and formality keyword arguments.
+        """
+        scenario = self.get_context()
+        formality = 'prefer_less' if scenario not in ["Medical Services 医疗", "Social Services 社会服务"] else 'prefer_more'
+        client = self.translation_client
+        if client is None:
+            options = {'auth_key': DEEPL_API_KEY or self.DEEPL_API_KEY} if self.translation_backend in ('deepl', 'hedged') else {}
+            client = get_translation_client(self.translation_backend, **options)
+        return client, {'context': self.get_scenarios()[scenario], 'scenario': scenario, 'formality': formality}
+
+    def translation_direction(self, language=None):
+        """
+        Get the DeepL source and target language codes for a spoken language.
+
+        Args:
+            language (str): Spoken language, the current one if not given.
+
+        Returns:
+            tuple: Source and target language codes.
+        """
+        if (language or self.spoken_language) == "ZH":
+            return 'ZH', 'EN-GB'
+        return 'EN', 'ZH-HANS'
+
+    def line_translator(self, line=None):
+        """
+        Get the incremental translator of a line, creating it on first use and forgetting the least recently used
+        line beyond max_line_translators.
+
+        Args:
+            line (int): Index of the line, the current line if not given.
+
+        Returns:
+            IncrementalTranslator: The translator holding the committed translations of the line.
+        """
+        if line is None:
+            line = self.line_offset + len(self.speech_text) - 1
+        translator = self.line_translators.get(line)
+        if translator is None:
+            translator = self.line_translators[line] = IncrementalTranslator(self.translate_batch,
+                                                                             self.translate_batch_async)
+            while len(self.line_translators) > self.max_line_translators:
+                self.line_translators.popitem(last=False)
+        self.line_translators.move_to_end(line)
+        return translator
+
+    def translate_line(self, text, language=None, line=None):
+        """
+        Translate a spoken line in the direction of the language it was spoken in.
+
+        In incremental mode, sentences that are already complete are translated once and reused, and only the
+        unfinished tail of the line is translated again.
+
+        Args:
+            text (str): The full line spoken so far.
+            language (str): Language the line was spoken in, the current spoken language if not given.
+            line (int): Index of the line, the current line if not given.
+
+        Returns:
+            str: Translated text.
+        """
+        source, target = self.translation_direction(language)
+        if self.incremental_translation:
+            return self.line_translator(line).update(text, source=source, target=target)
+        # Cache the line once it ends in a complete sentence, not while it is still growing
+        return self.translate_batch([text], source=source, target=target, cacheable=cacheable_count([text]))[0]
+
+    async def translate_line_async(self, text, language=None, line=None):
+        """
+        Translate a spoken line without blocking the event loop. See translate_line.
+
+        Args:
+            text (str): The full line spoken so far.
+            language (str): Language the line was spoken in, the current spoken language if not given.
+            line (int): Index of the line, the current line if not given.
+
+        Returns:
+            str: Translated text.
+        """
+        source, target = self.translation_direction(language)
+        if self.incremental_translation:
+            return await self.line_translator(line).update_async(text, source=source, target=target)
+        return (await self.translate_batch_async([text], source=source, target=target,
+                                                 cacheable=cacheable_count([text])))[0]
 
     def set_input_source(self, input_device):
         """
@@ -78,16 +256,44 @@ class Lumino:
             print(f"Error setting microphone source: {e}")
             self.source = sr.Microphone(sample_rate=16000)  # Set default microphone
 
+    def set_capture_mode(self, capture_mode):
+        """
+        Set where the audio comes from.
+
+        Args:
+            capture_mode (str): 'server' to record the server's microphone, or 'browser' to use audio streamed
+                from the client into the ring buffer.
+        """
+        self.capture_mode = capture_mode
+        self.audio_buffer.clear()
+
     def set_language(self, speaking_language):
         """
         Set the spoken and target languages.
-        
+
+        Can be called while recognition is running: the recognition loop reads the spoken language for every chunk,
+        so the switch takes effect on the next chunk and starts a new line, without restarting audio capture.
+
         Args:
             speaking_language (str): Spoken language.
         """
         self.target_language = self.spoken_language
         self.spoken_language = speaking_language
 
+    def set_auto_language(self, enabled):
+        """
+        Turn automatic language detection on or off.
+
+        In auto mode, Whisper detects whether each utterance is English or Chinese, which picks the translation
+        direction, so both speakers can talk without switching the language by hand. The detected language is
+        pinned for the rest of the utterance, so continuing speech is decoded without another detection pass.
+
+        Args:
+            enabled (bool): True to detect the spoken language, False to use spoken_language.
+        """
+        self.auto_language = enabled
+        self.utterance_language = None
+
     def generate_context(self, prompt=""):
         """
         Generate conversation context based on the current scenario and previous conversation.
@@ -98,11 +304,83 @@ class Lumino:
         Returns:
             str: Generated context text.
         """
-        context_prompt = (f"Explain this conversation for me so far in as few sentences as possible: {prompt}."
-                          f"Try to infer the context of the conversation, where the scenario is {self.get_scenarios()[self.get_context()]}"
-                          f" given all the previous lines. Give the entire output in {self.target_language} language")
-        response = self.model.generate_content(f"{context_prompt}")
-        return response.text
+        return "".join(self.generate_context_stream(prompt))
+
+    def generate_context_stream(self, prompt=""):
+        """
+        Generate conversation context, yielding the text as the model streams it.
+
+        The request is abandoned when the caller stops iterating, e.g. because newer speech superseded it.
+
+        Args:
+            prompt (str): Current conversation text.
+
+        Yields:
+            str: Successive chunks of the generated context text.
+        """
+        self.memory.fold()  # Summarize old turns first if the memory is over its budget
+        if self.model is None:
+            self.model = get_generative_model()
+        response = self.model.generate_content(self.context_prompt(prompt), stream=True)
+        for chunk in response:
+            yield chunk.text
+
+    async def generate_context_stream_async(self, prompt=""):
+        """
+        Generate conversation context without blocking the event loop, yielding the text as the model streams it.
+        The request is cancelled when the consuming task is, and times out after context_timeout seconds.
+
+        Args:
+            prompt (str): Current conversation text.
+
+        Yields:
+            str: Successive chunks of the generated context text.
+        """
+        await asyncio.to_thread(self.memory.fold)
+        if self.model is None:
+            self.model = await asyncio.to_thread(get_generative_model)
+        response = await self.model.generate_content_async(self.context_prompt(prompt), stream=True,
+                                                           request_options={'timeout': self.context_timeout})
+        async for chunk in response:
+            yield chunk.text
+
+    def context_prompt(self, prompt):
+        """
+        Build the context generation prompt for the current line, preceded by the conversation memory.
+
+        Args:
+            prompt (str): Current conversation text.
+
+        Returns:
+            str: The prompt.
+        """
+        history = self.memory.render()
+        if history:
+            prompt = f"{history}\n{self.line_language or self.spoken_language}: {prompt}"
+        return (f"Explain this conversation for me so far in as few sentences as possible: {prompt}."
+                f"Try to infer the context of the conversation, where the scenario is {self.get_scenarios()[self.get_context()]}"
+                f" given all the previous lines. Give the entire output in {self.target_language} language")
+
+    def summarize(self, summary, turns, max_tokens):
+        """
+        Update the rolling summary of the conversation with turns that are folded out of the recent memory.
+
+        Args:
+            summary (str): Summary of the conversation before the turns, may be empty.
+            turns (list): (language, text) of the folded turns, oldest first.
+            max_tokens (int): Token budget of the summary.
+
+        Returns:
+            str: The updated summary.
+        """
+        lines = "\n".join(f"{language}: {text}" for language, text in turns)
+        summary_prompt = (f"Here is a summary of a conversation so far: {summary or 'None yet'}\n"
+                          f"Update the summary with these following lines of the conversation:\n{lines}\n"
+                          f"Keep the facts needed to follow the conversation, in under {max_tokens // 2} words. "
+                          f"Only output the summary.")
+        if self.model is None:
+            self.model = get_generative_model()
+        return self.model.generate_content(summary_prompt).text
 
     def get_context(self):
         """
@@ -121,6 +399,7 @@ class Lumino:
             context_scenario (str): Selected scenario.
         """
         self.selected_scenario = context_scenario
+        self.line_translators.clear()  # Committed translations used the previous scenario
 
     def get_scenarios(self):
         """
@@ -137,6 +416,7 @@ class Lumino:
         """
         self.stop_event.clear()
         self.stop_listening = None
+        self.vad.reset()
 
     def stop_recognition(self):
         """
@@ -146,22 +426,32 @@ class Lumino:
         if self.stop_listening is not None:
             self.stop_listening()
             self.stop_listening = None
-        self.audio_queue.queue.clear()
+        self.audio_accumulator.drain(self.audio_queue)  # Discard audio still waiting in the queue
+        self.audio_buffer.clear()
 
     def clear_conversation(self):
         """
-        Clear the current conversation history for a new session.
+        Clear the current conversation history for a new session, closing its session log.
         """
+        self.memory.clear()
         self.speech_text = ['']
+        self.line_offset = 0
         self.spoken_line = ""
+        self.line_time = None
+        self.line_language = None
+        self.utterance_language = None
+        self.line_translators.clear()
 
-    def speech_recognition(self):
+    def microphone_audio(self):
         """
-        Perform speech recognition, generate recognized text and translated content.
-        
+        Capture audio from the server's microphone. Nothing is opened if recognition was stopped before it started,
+        e.g. while the model was loading.
+
         Yields:
-            tuple: Contains recognized text, translated text, and generated context.
+            np.ndarray: float32 samples of each captured chunk, or None when no audio arrived for a while.
         """
+        if self.stop_event.is_set():
+            return
         print("Setting up microphone")
         if self.source is None:
             self.source = sr.Microphone(sample_rate=16000)
@@ -180,41 +470,252 @@ class Lumino:
 
         print("Recording...")
         # Save the stop function
+        if self.stop_event.is_set():
+            return  # Stopped while adjusting for ambient noise
         self.stop_listening = self.recognizer.listen_in_background(self.source, transcript_data, phrase_time_limit=self.record_timeout)
-        audio_data = b''
+        if self.stop_event.is_set() and self.stop_listening is not None:
+            # Stopped while the listener was starting, before stop_recognition could stop it
+            self.stop_listening()
+            self.stop_listening = None
 
         while not self.stop_event.is_set():
+            yield self.audio_accumulator.drain(self.audio_queue, timeout=0.25)
+
+    def browser_audio(self):
+        """
+        Read audio streamed from the browser into the ring buffer.
+
+        Waits for at least record_timeout seconds of audio, like the phrase time limit of the microphone capture.
+        Each chunk is a view into the ring buffer and is only released once the caller asks for the next one.
+
+        Yields:
+            np.ndarray: float32 samples of each chunk, or None when no audio arrived for a while.
+        """
+        print("Receiving audio from the browser...")
+        min_samples = int(self.record_timeout * SAMPLE_RATE)
+        while not self.stop_event.is_set():
+            audio_np = self.audio_buffer.read(min_samples=min_samples, timeout=0.25)
+            yield audio_np
+            if audio_np is None:
+                continue
+            self.audio_buffer.consume(len(audio_np))
+
+    def commit_line(self, now, language):
+        """
+        Commit the current line once nothing has been said for line_timeout seconds, or when the spoken language
+        has changed since the line started, so the next speech starts a new entry in speech_text.
+
+        Args:
+            now (float): Current time from time.monotonic().
+            language (str): Spoken language of the next chunk.
+        """
+        if self.speech_text[-1] == "":
+            return
+        if language != self.line_language or (self.line_time is not None and now - self.line_time > self.line_timeout):
+            self.remember_line()
+            self.speech_text.append("")
+            if len(self.speech_text) > self.max_transcript_lines:
+                # Older lines only live on in the conversation memory
+                dropped = len(self.speech_text) - self.max_transcript_lines
+                del self.speech_text[:dropped]
+                self.line_offset += dropped
+
+    def remember_line(self):
+        """
+        Add the current line to the conversation memory.
+        """
+        self.memory.add(self.line_language, self.speech_text[-1], line=self.line_offset + len(self.speech_text) - 1,
+                        session=self.session_id)
+
+    def gate_chunk(self, audio_np):
+        """
+        Start the trace of a dequeued chunk and gate it with the voice activity detector.
+
+        Args:
+            audio_np (np.ndarray): float32 samples of the chunk.
+
+        Returns:
+            tuple: The audio around the speech, or None if there is no speech, and the ChunkTrace of the chunk.
+        """
+        trace = ChunkTrace(self.session_id, len(audio_np) / SAMPLE_RATE)
+        DEQUEUED_AUDIO.observe(trace.audio_seconds)
+        if self.vad_enabled:
+            audio_np = self.vad.trim(audio_np)
+            if audio_np is None:
+                VAD_DROPPED.inc(trace.audio_seconds)
+                AUDIO_CHUNKS.labels('silent').inc()
+                trace.mark('dropped')
+                return None, trace  # Silence, nothing for Whisper to transcribe
+            VAD_DROPPED.inc(trace.audio_seconds - len(audio_np) / SAMPLE_RATE)
+        return audio_np, trace
+
+    def decoding_language(self):
+        """
+        Get the language the next chunk is decoded in. Read once per chunk, so a switch mid-chunk applies from the
+        next chunk.
+
+        Returns:
+            str: The spoken language, or the pinned language of the utterance in auto mode, or None to detect it.
+        """
+        return self.utterance_language if self.auto_language else self.spoken_language
+
+    def decoding_prompt(self, language):
+        """
+        Get the text a chunk continues from, so Whisper decodes a short chunk with the context of its sentence.
+
+        Args:
+            language (str): Spoken language the chunk is decoded in, or None if it is detected.
+
+        Returns:
+            str: The end of the latest line if it was spoken in the same language, otherwise None.
+        """
+        if language is None or language != self.line_language or not self.speech_text[-1]:
+            return None
+        return self.speech_text[-1][-self.prompt_chars:]
+
+    def submit_chunk(self, audio_np, language=None):
+        """
+        Queue gated audio for transcription by the shared Whisper model.
+
+        Args:
+            audio_np (np.ndarray): float32 samples of the speech.
+            language (str): Spoken language to decode in, or None to detect English or Chinese.
+
+        Returns:
+            Future: Resolves to the transcription result of the InferenceScheduler.
+        """
+        return self.inference.submit(audio_np, WHISPER_LANGUAGES.get(language), languages=tuple(WHISPER_LANGUAGES.values()),
+                                     prompt=self.decoding_prompt(language), session=self.session_id)
+
+    def finish_chunk(self, audio_np, result, elapsed, trace):
+        """
+        Record the transcription of a chunk in its trace and metrics.
+
+        Args:
+            audio_np (np.ndarray): float32 samples that were transcribed.
+            result (dict): Transcription result of the InferenceScheduler.
+            elapsed (float): Seconds the transcription took.
+            trace (ChunkTrace): Trace of the chunk.
+
+        Returns:
+            tuple: The recognized text and the spoken language it was decoded in, None if the chunk was dropped
+                without being transcribed.
+        """
+        if result.get('dropped'):
+            AUDIO_CHUNKS.labels('dropped').inc()
+            trace.mark('dropped')
+            return "", None
+        text = result['text']
+        language = "ZH" if result['language'] == "zh" else "EN"
+        rtf = elapsed / (len(audio_np) / SAMPLE_RATE)
+        STAGE_SECONDS.labels('transcription').observe(elapsed)
+        WHISPER_RTF.observe(rtf)
+        AUDIO_CHUNKS.labels('text' if text else 'empty').inc()
+        trace.mark('transcription', rtf=round(rtf, 3), language=language)
+        return text, language
+
+    def recognize_chunk(self, audio_np, language=None):
+        """
+        Gate a dequeued chunk with the voice activity detector and transcribe it, recording its trace and metrics.
+
+        Args:
+            audio_np (np.ndarray): float32 samples of the chunk.
+            language (str): Spoken language to decode in, or None to detect English or Chinese.
+
+        Returns:
+            tuple: The recognized text (empty if there was no speech), the spoken language it was decoded in and
+                the ChunkTrace of the chunk.
+        """
+        audio_np, trace = self.gate_chunk(audio_np)
+        if audio_np is None:
+            return "", language, trace
+        start = time.monotonic()
+        result = self.submit_chunk(audio_np, language).result()
+        text, language = self.finish_chunk(audio_np, result, time.monotonic() - start, trace)
+        return text, language, trace
+
+    def add_text(self, now, text, language):
+        """
+        Add the recognized text of a chunk to the conversation, starting a new line if needed.
+
+        Args:
+            now (float): Time the chunk was dequeued, from time.monotonic().
+            text (str): Recognized text, empty if there was no speech.
+            language (str): Spoken language the text was decoded in, None if the chunk was dropped untranscribed.
+
+        Returns:
+            tuple: Index of the current line in the conversation, the recognized text of that line so far, the
+                language it was spoken in and whether this is the first text of a new line, or None if there was
+                no text.
+        """
+        if self.auto_language and language is not None:  # A dropped chunk says nothing about the language
+            # Keep decoding in the detected language while the speech runs on into the next chunk
+            self.utterance_language = language if text and self.vad_enabled and self.vad.in_speech else None
+            if text and language != self.spoken_language:
+                self.set_language(language)  # Context is generated in the other speaker's language
+                if self.on_language_change is not None:
+                    self.on_language_change(language)
+        if not text:
+            return None
+        self.commit_line(now, language)
+        is_new_line = self.speech_text[-1] == ""
+        if is_new_line:
+            self.speech_text[-1] = text
+        else:
+            self.speech_text[-1] += f" {text}"
+        self.spoken_line = self.speech_text[-1]
+        self.line_time = time.monotonic()
+        self.line_language = language
+
+        # Print recognized text to the console
+        print(f"Recognized Text: {text}")
+        return self.line_offset + len(self.speech_text) - 1, self.spoken_line, language, is_new_line
+
+    def speech_recognition(self):
+        """
+        Perform speech recognition on the audio input.
+
+        Blocks waiting for audio instead of polling, and starts a new line in speech_text once nothing has been
+        said for line_timeout seconds or the spoken language has changed. The spoken language is read once per
+        chunk, so it can be switched while recognition runs. In auto mode it is detected by Whisper at the start
+        of each utterance and pinned while the voice activity detector hears the speech continue. Translation and
+        context generation are not done here, so recognized text is available as soon as Whisper has transcribed a
+        chunk. See pipeline.RecognitionPipeline for running them concurrently.
+
+        Yields:
+            tuple: Index of the current line in the conversation, the recognized text of that line so far, the language
+                it was spoken in, whether this is the first text of a new line, and the ChunkTrace of the chunk.
+        """
+        audio_chunks = self.browser_audio() if self.capture_mode == 'browser' else self.microphone_audio()
+        for audio_np in audio_chunks:
             try:
-                if not self.audio_queue.empty():
-                    audio_data = b''.join(list(self.audio_queue.queue))
-                    self.audio_queue.queue.clear()
-                    audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
-                    result = self.audio_model.transcribe(audio_np, fp16=torch.cuda.is_available())
-                    text = result['text'].strip()
-                    if self.speech_text[-1] == "":
-                        self.speech_text[-1] = text
-                    else:
-                        self.speech_text[-1] += f" {text}"
-                    self.spoken_line = self.speech_text[-1]
-                    if self.spoken_language == "ZH":
-                        translation = self.translate(source='ZH', target='EN-GB', text=self.spoken_line)
-                    else:
-                        translation = self.translate(text=self.spoken_line)
-                    context = self.generate_context(self.spoken_line)
-
-                    # Print recognized and translated text to the console
-                    print(f"Recognized Text: {text}")
-                    print(f"Translated Text: {translation}")
-                    yield self.spoken_line, translation, context
+                now = time.monotonic()
+                if audio_np is None:
+                    continue
+
+                text, language, trace = self.recognize_chunk(audio_np, self.decoding_language())
+                update = self.add_text(now, text, language)
+                if update is not None:
+                    yield (*update, trace)
 
             except KeyboardInterrupt:
-                return self.speech_text, None, None
+                return
             except Exception as e:
                 print(f"Error during recognition: {e}")
+        self.finish_recognition()
+
+    def finish_recognition(self):
+        """
+        Log the voice activity statistics once speech recognition has stopped.
+        """
+        if self.vad_enabled:
+            stats = self.vad.stats()
+            print(f"Voice activity gate dropped {stats['dropped_seconds']:.1f}s of {stats['total_seconds']:.1f}s of audio")
         print("Speech recognition stopped.")
 
 
 if __name__ == '__main__':
+    from pipeline import RecognitionPipeline
+
     lumino = Lumino()
-    for text, translation, context in lumino.speech_recognition():
-        print(text, translation, context)
\ No newline at end of file
+    RecognitionPipeline(lumino, lambda event, data: print(event, data)).run()
@@ -0,0 +1,250 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import deque
+
+# Directory turns folded out of the conversation memory are spilled to. No transcript is kept unless it is set
+SESSION_LOG_DIR = os.getenv("LUMINO_SESSION_LOG_DIR")
+
+# Characters that take about one token each: CJK ideographs, punctuation and full-width forms
+CJK_CHARACTER = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of model tokens in a text without a tokenizer.
+
+    Args:
+        text (str): English and/or Chinese text.
+
+    Returns:
+        int: About one token per Chinese character and per four other characters.
+    """
+    cjk = len(CJK_CHARACTER.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text, budget):
+    """
+    Cut a text to its longest prefix that fits in a token budget.
+
+    Args:
+        text (str): Text to cut.
+        budget (int): Maximum number of tokens.
+
+    Returns:
+        str: The text, or its longest prefix within the budget.
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
+
+
+class SessionLog:
+    """
+    Append-only transcript of a conversation on disk, one JSON object per line.
+
+    The file is created on the first write and named after the time it was created, so each conversation gets its
+    own file. Records are queued and written by a background thread, which flushes the file whenever the queue
+    runs empty, so writing never blocks the caller on disk I/O.
+    """
+
+    def __init__(self, directory=SESSION_LOG_DIR):
+        """
+        Initialize the session log.
+
+        Args:
+            directory (str): Directory the transcript files are written to.
+        """
+        self.directory = directory
+        self.path = None  # Path of the current transcript file, once the writer has created it
+        self.records = None  # Queue of records to write, with None to close the file, while a writer is running
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        """
+        Queue a record to be appended to the transcript, starting the writer thread if needed.
+
+        Args:
+            record (dict): JSON-serializable record of a line.
+        """
+        with self.lock:
+            if self.records is None:
+                self.records = queue.Queue()
+                threading.Thread(target=self.writer, args=(self.records,), name="session-log-writer",
+                                 daemon=True).start()
+            self.records.put(record)
+
+    def writer(self, records):
+        """
+        Append queued records to a new transcript file until the log is closed.
+
+        Args:
+            records (queue.Queue): Records of this file, ending with None.
+        """
+        file = None
+        try:
+            while True:
+                record = records.get()
+                if record is None:
+                    return
+                if file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl"
+                    self.path = os.path.join(self.directory, name)
+                    file = open(self.path, 'a', encoding='utf-8')
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                if records.empty():
+                    file.flush()
+        except OSError as e:
+            print(f"Error writing the session log: {e}")
+        finally:
+            if file is not None:
+                file.close()
+
+    def close(self):
+        """
+        Close the transcript once the queued records are written. The next write starts a new file.
+        """
+        with self.lock:
+            if self.records is not None:
+                self.records.put(None)
+                self.records = None
+
+
+class ConversationMemory:
+    """
+    Bounded memory of a conversation for context prompts.
+
+    Recent turns are kept verbatim. Once they exceed their share of the token budget, the oldest turns are folded
+    into a rolling summary by the summarize function, which updates the previous summary with the folded turns
+    rather than summarizing the whole conversation again. The summary is kept within its own share of the budget,
+    so the rendered memory never exceeds token_budget however long the conversation runs. Turns folded out of the
+    recent turns are spilled to the session log, if there is one.
+    """
+
+    def __init__(self, summarize_fn=None, token_budget=800, summary_budget=300, log=None):
+        """
+        Initialize the conversation memory.
+
+        Args:
+            summarize_fn (callable): Function called as summarize_fn(summary, turns, max_tokens) returning the summary
+                updated with a list of (language, text) turns. Folded turns are dropped if not given or if it fails.
+            token_budget (int): Maximum number of tokens of the rendered memory.
+            summary_budget (int): Tokens of the budget reserved for the summary.
+            log (SessionLog): Transcript the folded turns are spilled to, or None to keep no transcript.
+        """
+        self.summarize_fn = summarize_fn
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.log = log
+        self.summary = ""
+        self.turns = deque()  # (language, text, tokens, record) of the recent turns, oldest first
+        self.turn_tokens = 0  # Tokens of the recent turns
+        self.cleared = 0  # Number of times the memory was cleared, so a fold in progress can tell
+        self.lock = threading.Lock()
+        self.fold_lock = threading.Lock()  # Serializes folding, which calls the model outside the lock
+
+    def turn_budget(self):
+        """
+        Get the tokens of the budget available to recent turns.
+        """
+        return self.token_budget - self.summary_budget
+
+    def add(self, language, text, **fields):
+        """
+        Add a committed turn of the conversation.
+
+        Args:
+            language (str): Language the turn was spoken in.
+            text (str): Text of the turn.
+            **fields: Extra fields for the session log, e.g. the line index and session ID.
+        """
+        record = {'time': time.time(), 'language': language, 'text': text, **fields}
+        # The label added to each turn when rendering is counted too
+        tokens = estimate_tokens(text) + 2
+        with self.lock:
+            self.turns.append((language, text, tokens, record))
+            self.turn_tokens += tokens
+
+    def fold(self):
+        """
+        Fold the oldest turns into the summary if the recent turns exceed their budget.
+
+        Turns are folded until the recent turns use at most half of their budget, so that the summarize function is
+        called once per several turns rather than on every turn. Folded turns are spilled to the session log. May
+        call the model, so it should not be called on the recognition thread.
+        """
+        with self.fold_lock:
+            with self.lock:
+                if self.turn_tokens <= self.turn_budget():
+                    return
+                folded = []
+                while self.turns and self.turn_tokens > self.turn_budget() // 2:
+                    language, text, tokens, record = self.turns.popleft()
+                    self.turn_tokens -= tokens
+                    folded.append((language, text))
+                    if self.log is not None:
+                        self.log.write(record)
+                summary = self.summary
+                cleared = self.cleared
+
+            if self.summarize_fn is not None:
+                try:
+                    summary = self.summarize_fn(summary, folded, self.summary_budget)
+                except Exception as e:
+                    print(f"Error summarizing the conversation, {len(folded)} turns dropped from memory: {e}")
+
+            with self.lock:
+                if cleared == self.cleared:
+                    self.summary = truncate_tokens(summary.strip(), self.summary_budget)
+
+    def render(self):
+        """
+        Render the memory for a prompt. Turns added since the last fold that do not fit in the budget are left out,
+        oldest first.
+
+        Returns:
+            str: The summary of earlier turns followed by the recent turns, one per line.
+        """
+        with self.lock:
+            lines = []
+            tokens_used = 0
+            for language, text, tokens, _ in reversed(self.turns):
+                tokens_used += tokens
+                if tokens_used > self.turn_budget():
+                    break
+                lines.append(f"{language}: {text}")
+            if self.summary:
+                lines.append(f"Summary of earlier conversation: {self.summary}")
+        return '\n'.join(reversed(lines))
+
+    def clear(self):
+        """
+        Forget the conversation and close the session log, so the next conversation starts a new file.
+        """
+        with self.lock:
+            self.summary = ""
+            self.turns.clear()
+            self.turn_tokens = 0
+            self.cleared += 1
+        if self.log is not None:
+            self.log.close()
+
+    def close(self):
+        """
+        Close the session log, e.g. when the client disconnects.
+        """
+        if self.log is not None:
+            self.log.close()
@@ -0,0 +1,267 @@
+import itertools
+import json
+import logging
+import threading
+import time
+
+trace_log = logging.getLogger('lumino.trace')  # Structured per-chunk timing log, one JSON object per line
+
+
+class Metric:
+    """
+    Base class of the metrics exposed on /metrics in the Prometheus text format. A metric has one value (or
+    histogram) per combination of label values.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Initialize the metric and register it.
+
+        Args:
+            name (str): Metric name.
+            documentation (str): Help text of the metric.
+            labelnames (tuple): Names of the labels.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}  # Label values -> child metric
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """
+        Get the child metric for the given label values.
+        """
+        with self.lock:
+            if values not in self.children:
+                self.children[values] = self.new_child()
+            return self.children[values]
+
+    def default(self):
+        """
+        Get the child metric of a metric without labels.
+        """
+        return self.labels()
+
+    def label_text(self, values, extra=()):
+        """
+        Format label values as a Prometheus label set.
+        """
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def render(self):
+        """
+        Render the metric in the Prometheus text format.
+
+        Returns:
+            list: Lines of the metric.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            lines.extend(child.render(self, values))
+        return lines
+
+
+class Value:
+    """
+    A single counter or gauge value.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def render(self, metric, values):
+        return [f"{metric.name}{metric.label_text(values)} {self.value}"]
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count.
+    """
+
+    type = 'counter'
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1.0):
+        self.default().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down.
+    """
+
+    type = 'gauge'
+
+    def new_child(self):
+        return Value()
+
+    def inc(self, amount=1.0):
+        self.default().inc(amount)
+
+    def dec(self, amount=1.0):
+        self.default().dec(amount)
+
+    def set(self, value):
+        self.default().set(value)
+
+
+class HistogramValue:
+    """
+    Observations of a histogram, counted in cumulative buckets.
+    """
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def render(self, metric, values):
+        with self.lock:
+            lines = [f"{metric.name}_bucket{metric.label_text(values, [('le', bound)])} {count}"
+                     for bound, count in zip(self.buckets, self.counts)]
+            lines.append(f"{metric.name}_bucket{metric.label_text(values, [('le', '+Inf')])} {self.count}")
+            lines.append(f"{metric.name}_sum{metric.label_text(values)} {self.sum}")
+            lines.append(f"{metric.name}_count{metric.label_text(values)} {self.count}")
+        return lines
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. latencies in seconds.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default().observe(value)
+
+
+REGISTRY = []  # All metrics, in the order they are rendered
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text format.
+
+    Returns:
+        str: The metrics page.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of the recognition pipeline
+AUDIO_CHUNKS = Counter('lumino_audio_chunks_total', 'Audio chunks dequeued for recognition', ['result'])
+DEQUEUED_AUDIO = Histogram('lumino_dequeued_audio_seconds', 'Seconds of audio waiting when a chunk is dequeued; '
+                           'more than the recording timeout means recognition is falling behind',
+                           buckets=(0.5, 1, 2, 3, 5, 10, 20, 30))
+STAGE_SECONDS = Histogram('lumino_stage_seconds', 'Time spent in each pipeline stage', ['stage'])
+LATENCY_FROM_CAPTURE = Histogram('lumino_latency_from_capture_seconds', 'Time from capturing a chunk until each '
+                                 'result for it is emitted', ['event'])
+QUEUE_DEPTH = Gauge('lumino_queue_depth', 'Work items waiting in each pipeline stage', ['stage'])
+API_ERRORS = Counter('lumino_api_errors_total', 'Failed calls to external services', ['api'])
+TRANSLATIONS_CANCELLED = Counter('lumino_translations_cancelled_total', 'Async translations cancelled for newer text '
+                                 'of the same line')
+CONTEXT_CANCELLED = Counter('lumino_context_streams_cancelled_total', 'Context streams cancelled for newer speech')
+CACHE_LOOKUPS = Counter('lumino_translation_cache_lookups_total', 'Translation cache lookups by result', ['result'])
+WHISPER_RTF = Histogram('lumino_whisper_rtf', 'Whisper real-time factor: transcription time over audio duration',
+                        buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5))
+VAD_DROPPED = Counter('lumino_vad_dropped_seconds_total', 'Seconds of audio dropped as silence before Whisper')
+SOCKET_PAYLOAD_BYTES = Counter('lumino_socket_payload_bytes_total', 'Bytes of line updates and snapshots sent to '
+                               'clients as binary msgpack messages', ['event'])
+TRANSLATION_BACKEND_SECONDS = Histogram('lumino_translation_backend_seconds', 'Time taken by successful requests to '
+                                        'each translation backend', ['backend'])
+TRANSLATION_BACKEND_ERRORS = Counter('lumino_translation_backend_errors_total', 'Failed requests to each translation '
+                                     'backend', ['backend'])
+TRANSLATION_HEDGES = Counter('lumino_translation_hedges_total', 'Routed translations by outcome: answered before the '
+                             'hedge delay, or after hedging by the first or the hedged backend', ['outcome'])
+TRANSLATION_CIRCUIT_OPEN = Gauge('lumino_translation_circuit_open', 'Whether the circuit breaker of each translation '
+                                 'backend is open', ['backend'])
+
+
+class ChunkTrace:
+    """
+    Timestamps of one audio chunk as it moves through the pipeline.
+
+    Each chunk gets an ID when it is dequeued. Its capture time is estimated as the dequeue time minus the length of
+    the audio, since audio is captured in real time. Every marked stage is written to the structured trace log.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, session, audio_seconds):
+        """
+        Start the trace of a dequeued chunk.
+
+        Args:
+            session (str): ID of the session the chunk belongs to.
+            audio_seconds (float): Length of the dequeued audio in seconds.
+        """
+        self.id = next(self.ids)
+        self.session = session
+        self.audio_seconds = audio_seconds
+        now = time.time()
+        self.times = {'capture': now - audio_seconds, 'dequeue': now}
+
+    def mark(self, stage, **fields):
+        """
+        Record that the chunk reached a stage and log it.
+
+        Args:
+            stage (str): Name of the stage, e.g. 'transcription', 'translation', 'context' or 'emit'.
+            **fields: Extra fields for the log record.
+
+        Returns:
+            float: Seconds since the chunk was captured.
+        """
+        now = time.time()
+        self.times[stage] = now
+        since_capture = now - self.times['capture']
+        if trace_log.isEnabledFor(logging.INFO):  # Only the server configures the trace log, skip encoding otherwise
+            trace_log.info(json.dumps({'chunk': self.id, 'session': self.session, 'stage': stage, 'time': now,
+                                       'since_capture_ms': round(since_capture * 1000, 1),
+                                       'audio_seconds': round(self.audio_seconds, 3), **fields}))
+        return since_capture
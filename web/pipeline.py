@@ -0,0 +1,368 @@
+import itertools
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import API_ERRORS, CONTEXT_CANCELLED, LATENCY_FROM_CAPTURE, QUEUE_DEPTH, STAGE_SECONDS
+
+# Text ending in a sentence or phrase boundary, in English or Chinese
+PHRASE_BOUNDARY = re.compile(r'[.!?,;:。！？，；：]\s*$')
+
+
+class StageWorker:
+    """
+    Background worker running one stage of the recognition pipeline in its own thread.
+
+    Work items wait in a bounded, coalescing queue: submitting an item with the same key as an item that is still
+    waiting replaces it, since only the latest version of a line is worth processing. When the queue is full the
+    oldest waiting item is dropped, so submitting never blocks the stage upstream.
+    """
+
+    def __init__(self, name, handler, on_result, maxsize=4):
+        """
+        Initialize the stage worker.
+
+        Args:
+            name (str): Name of the stage, used in logs and as the thread name.
+            handler (callable): Function processing one work item and returning its result.
+            on_result (callable): Function called as on_result(key, item, result) once an item is processed.
+            maxsize (int): Maximum number of waiting work items.
+        """
+        self.name = name
+        self.handler = handler
+        self.on_result = on_result
+        self.maxsize = maxsize
+        self.pending = OrderedDict()  # Waiting work items by key, oldest first
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=f"{name}-worker", daemon=True)
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+        self.thread.start()
+
+    def submit(self, key, item):
+        """
+        Queue a work item, replacing any waiting item with the same key.
+
+        Args:
+            key: Key identifying what the item is about, e.g. the line index.
+            item: The work item passed to the handler.
+        """
+        with self.condition:
+            if key not in self.pending:
+                if len(self.pending) >= self.maxsize:
+                    dropped, _ = self.pending.popitem(last=False)
+                    print(f"{self.name} stage is falling behind, dropped work for {dropped}")
+                else:
+                    QUEUE_DEPTH.labels(self.name).inc()
+            self.pending[key] = item
+            self.condition.notify()
+
+    def stop(self):
+        """
+        Stop the worker. Items still waiting are discarded.
+        """
+        with self.condition:
+            self.stopped = True
+            QUEUE_DEPTH.labels(self.name).dec(len(self.pending))
+            self.pending.clear()
+            self.condition.notify()
+
+    def join(self, timeout=None):
+        """
+        Wait for the worker thread to finish.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+        """
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def run(self):
+        """
+        Process work items until the worker is stopped.
+        """
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key, item = self.pending.popitem(last=False)
+                QUEUE_DEPTH.labels(self.name).dec()
+            try:
+                result = self.handler(item)
+            except Exception as e:
+                print(f"Error in {self.name} stage: {e}")
+                continue
+            self.on_result(key, item, result)
+
+
+class ContextScheduler:
+    """
+    Decide when to regenerate context for the conversation, and only deliver results that are still current.
+
+    Context is regenerated when a line reaches a sentence or phrase boundary, or once no new text has arrived for
+    quiet_interval seconds. Updates that arrive while waiting are coalesced into a single request for the latest
+    text.
+
+    Context is streamed: each chunk is delivered as soon as the model produces it. A stream is cancelled as soon as a
+    newer request becomes due, unless nothing has been delivered for max_result_age seconds, so that continuous
+    speech still gets regular context updates.
+    """
+
+    def __init__(self, generate_fn, on_result, on_chunk=None, quiet_interval=1.5, max_result_age=4.0):
+        """
+        Initialize the context scheduler.
+
+        Args:
+            generate_fn (callable): Function generating context for the text of a line, returning an iterable of
+                text chunks.
+            on_result (callable): Function called as on_result(line, text, context, tag) to deliver a complete
+                result.
+            on_chunk (callable): Function called as on_chunk(line, stream, chunk, tag) to deliver each chunk of a
+                result, where stream is a number identifying the generation the chunk belongs to.
+            quiet_interval (float): Seconds without new text after which context is regenerated.
+            max_result_age (float): Seconds after which a result is delivered even if a newer request is due.
+        """
+        self.generate_fn = generate_fn
+        self.on_result = on_result
+        self.on_chunk = on_chunk
+        self.quiet_interval = quiet_interval
+        self.max_result_age = max_result_age
+        self.condition = threading.Condition()
+        self.latest = None  # (line, text) of the most recent update
+        self.latest_tag = None  # Caller data passed back with the result of the most recent update
+        self.deadline = None  # Monotonic time at which the latest update is due, None if nothing is waiting
+        self.last_generated = None  # (line, text) context was last generated for
+        self.last_delivery = 0.0  # Monotonic time of the last delivered result
+        self.streams = itertools.count(1)  # Numbers identifying each generation
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="context-scheduler", daemon=True)
+
+    def start(self):
+        """
+        Start the scheduler thread.
+        """
+        self.thread.start()
+
+    def submit(self, line, text, tag=None):
+        """
+        Record the latest text of a line and schedule context generation for it.
+
+        Args:
+            line (int): Index of the line.
+            text (str): Text of the line so far.
+            tag: Caller data passed back to on_result with the result, e.g. the trace of the chunk.
+        """
+        with self.condition:
+            if (line, text) == self.latest:
+                return
+            self.latest = (line, text)
+            self.latest_tag = tag
+            now = time.monotonic()
+            self.deadline = now if PHRASE_BOUNDARY.search(text) else now + self.quiet_interval
+            self.condition.notify()
+
+    def stop(self):
+        """
+        Stop the scheduler. Waiting updates are discarded.
+        """
+        with self.condition:
+            self.stopped = True
+            self.deadline = None
+            self.condition.notify()
+
+    def join(self, timeout=None):
+        """
+        Wait for the scheduler thread to finish.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+        """
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def request_due(self):
+        """
+        Check whether a request has become due. Must be called with the condition held.
+
+        Returns:
+            bool: True if a request is due.
+        """
+        return self.deadline is not None and self.deadline <= time.monotonic()
+
+    def superseded(self):
+        """
+        Check whether the generation in progress should be cancelled for a newer request. Must be called with the
+        condition held.
+
+        Returns:
+            bool: True if a newer request is due and a result was delivered less than max_result_age seconds ago.
+        """
+        return self.request_due() and time.monotonic() - self.last_delivery < self.max_result_age
+
+    def run(self):
+        """
+        Generate context whenever a request becomes due, until the scheduler is stopped.
+        """
+        while True:
+            with self.condition:
+                while not self.stopped and not self.request_due():
+                    timeout = None if self.deadline is None else self.deadline - time.monotonic()
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                self.deadline = None
+                if self.latest == self.last_generated:
+                    continue
+                line, text = self.last_generated = self.latest
+                tag = self.latest_tag
+            stream = next(self.streams)
+
+            context = ""
+            cancelled = False
+            chunks = iter(self.generate_fn(text))
+            try:
+                for chunk in chunks:
+                    with self.condition:
+                        if self.stopped:
+                            return
+                        if self.superseded():
+                            cancelled = True
+                            break
+                    context += chunk
+                    if self.on_chunk is not None:
+                        self.on_chunk(line, stream, chunk, tag)
+            except Exception as e:
+                print(f"Error generating context: {e}")
+                continue
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()  # Abandon the request if it is still streaming
+            if cancelled:
+                print(f"Cancelled stale context for line {line}")
+                CONTEXT_CANCELLED.inc()
+                continue
+
+            with self.condition:
+                if self.stopped:
+                    return
+                self.last_delivery = time.monotonic()
+            self.on_result(line, text, context, tag)
+
+
+class RecognitionPipeline:
+    """
+    Run speech recognition, translation and context generation as concurrent stages.
+
+    Speech recognition runs in the calling thread and emits recognized text as soon as it is available. Translation
+    runs in its own worker and context generation is driven by a ContextScheduler, so the next audio chunk never
+    waits on DeepL or Gemini and each result is emitted as its own event once ready. Context is also emitted chunk by
+    chunk while Gemini streams it.
+    """
+
+    def __init__(self, lumino, emit):
+        """
+        Initialize the pipeline.
+
+        Args:
+            lumino (Lumino): The Lumino instance doing the recognition, translation and context generation.
+            emit (callable): Function called as emit(event, data) to deliver results, e.g. socketio.emit.
+        """
+        self.lumino = lumino
+        self.emit = emit
+        self.translation_worker = StageWorker('translation', self.translate, self.emit_translation)
+        self.context_scheduler = ContextScheduler(self.generate_context, self.emit_context, self.emit_context_chunk,
+                                                  quiet_interval=lumino.context_quiet_interval)
+        self.context_stream = None  # Number of the context stream last emitted
+
+    def translate(self, item):
+        """
+        Translate a line, recording the stage time and failed API calls.
+
+        Args:
+            item (tuple): Index of the line, its text, the language it was spoken in and the ChunkTrace of its
+                latest chunk.
+
+        Returns:
+            str: Translated text.
+        """
+        line, text, language, trace = item
+        start = time.monotonic()
+        try:
+            return self.lumino.translate_line(text, language, line=line)
+        except Exception:
+            API_ERRORS.labels('translation').inc()
+            raise
+        finally:
+            STAGE_SECONDS.labels('translation').observe(time.monotonic() - start)
+
+    def generate_context(self, text):
+        """
+        Stream the context of a line, recording the stage time and failed API calls.
+
+        Args:
+            text (str): Text of the line.
+
+        Yields:
+            str: Successive chunks of the generated context.
+        """
+        start = time.monotonic()
+        try:
+            yield from self.lumino.generate_context_stream(text)
+        except Exception:
+            API_ERRORS.labels('context').inc()
+            raise
+        finally:
+            STAGE_SECONDS.labels('context').observe(time.monotonic() - start)
+
+    def emit_translation(self, line, item, translation):
+        """
+        Emit the translation of a line.
+        """
+        print(f"Translated Text: {translation}")
+        self.emit('translation_result', {'line': line, 'translated_text': translation})
+        LATENCY_FROM_CAPTURE.labels('translation').observe(item[3].mark('translation', line=line))
+
+    def emit_context_chunk(self, line, stream, chunk, trace):
+        """
+        Emit a chunk of the context being generated for a line. The client appends chunks of the same stream and
+        starts over when a new stream begins.
+        """
+        self.emit('context_chunk', {'line': line, 'stream': stream, 'delta': chunk})
+        if stream != self.context_stream:
+            self.context_stream = stream
+            LATENCY_FROM_CAPTURE.labels('context_first_chunk').observe(trace.mark('context_first_chunk', line=line))
+
+    def emit_context(self, line, text, context, trace):
+        """
+        Emit the context generated for a line.
+        """
+        self.emit('context_result', {'line': line, 'generated_context': context})
+        LATENCY_FROM_CAPTURE.labels('context').observe(trace.mark('context', line=line))
+
+    def run(self):
+        """
+        Run the pipeline until speech recognition stops.
+        """
+        self.translation_worker.start()
+        self.context_scheduler.start()
+        try:
+            for line, text, language, is_new_line, trace in self.lumino.speech_recognition():
+                self.emit('recognition_result', {
+                    'line': line,
+                    'recognized_text': text,
+                    'language': language,
+                    'is_new_line': is_new_line  # True when the text starts a new line of the conversation
+                })
+                LATENCY_FROM_CAPTURE.labels('recognition').observe(trace.mark('emit', line=line))
+                self.translation_worker.submit(line, (line, text, language, trace))
+                self.context_scheduler.submit(line, text, trace)
+        finally:
+            self.translation_worker.stop()
+            self.context_scheduler.stop()
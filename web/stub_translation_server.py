@@ -0,0 +1,90 @@
+"""
+Local stand-in for the DeepL API, for testing translation routing without network access or API quota.
+
+Answers POST /v2/translate like DeepL, with form or JSON bodies, after a configurable latency. A share of requests
+can be made slow, to exercise hedging, or fail, to exercise the circuit breaker. Translations are the source texts
+tagged with the target language.
+
+Usage:
+    python stub_translation_server.py --port 8001 --latency 0.1 --slow-rate 0.1 --slow-latency 2
+    python stub_translation_server.py --port 8002 --latency 0.2
+
+    DEEPL_SERVER_URL=http://localhost:8001 DEEPL_SECONDARY_SERVER_URL=http://localhost:8002 python app.py
+"""
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class StubTranslationHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the DeepL translate endpoint. Its behaviour is set by the options of the server.
+    """
+
+    def do_POST(self):
+        options = self.server.options
+        if self.path.split('?')[0] != '/v2/translate':
+            self.send_json(404, {'message': 'Not found'})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or '{}')
+        else:
+            params = {key: values if key == 'text' else values[0] for key, values in parse_qs(body).items()}
+        texts = params.get('text', [])
+        texts = [texts] if isinstance(texts, str) else texts
+        target = params.get('target_lang', 'EN')
+
+        latency = options.latency + random.uniform(0, options.jitter)
+        if random.random() < options.slow_rate:
+            latency += options.slow_latency
+        time.sleep(latency)
+        if random.random() < options.error_rate:
+            self.send_json(options.error_status, {'message': 'Stub error'})
+            return
+        self.send_json(200, {'translations': [{'detected_source_language': params.get('source_lang', 'EN'),
+                                               'text': f"[{target}] {text}"} for text in texts]})
+
+    def send_json(self, status, data):
+        """
+        Send a JSON response.
+        """
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            super().log_message(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8001, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds each request takes')
+    parser.add_argument('--jitter', type=float, default=0.05, help='up to this many seconds added to each request')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='share of requests that are slow')
+    parser.add_argument('--slow-latency', type=float, default=2.0, help='seconds added to slow requests')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of failed requests')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StubTranslationHandler)
+    server.options = args
+    print(f"Stub DeepL server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
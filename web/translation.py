@@ -0,0 +1,797 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cache import get_translation_cache
+from metrics import TRANSLATION_BACKEND_ERRORS, TRANSLATION_BACKEND_SECONDS, TRANSLATION_CIRCUIT_OPEN, TRANSLATION_HEDGES
+
+# Sentence boundaries: English terminators must be followed by whitespace (so "2.5" is not split),
+# Chinese full-width terminators end a sentence on their own.
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|(?<=[。！？])\s*')
+# Text ending in a sentence terminator
+SENTENCE_END = re.compile(r'[.!?。！？]\s*$')
+
+
+def split_sentences(text):
+    """
+    Split a line of text into sentences.
+
+    Args:
+        text (str): Text to split.
+
+    Returns:
+        list: Non-empty sentences in order.
+    """
+    parts = (part.strip() for part in SENTENCE_BOUNDARY.split(text.strip()))
+    return [part for part in parts if part]
+
+
+def cacheable_count(sentences):
+    """
+    Get how many leading sentences of a line being spoken are worth caching: all but the unfinished tail, and the
+    tail too once it ends in a sentence terminator, e.g. a stock phrase said on its own line.
+
+    Args:
+        sentences (list): Sentences of the line, the last of which is its tail.
+
+    Returns:
+        int: Number of leading sentences to cache.
+    """
+    if sentences and SENTENCE_END.search(sentences[-1]):
+        return len(sentences)
+    return max(len(sentences) - 1, 0)
+
+
+def join_sentences(sentences, language):
+    """
+    Join translated sentences back into a single line.
+
+    Args:
+        sentences (list): Translated sentences.
+        language (str): Language code of the sentences.
+
+    Returns:
+        str: The joined line. Chinese text is joined without spaces.
+    """
+    separator = '' if language.upper().startswith('ZH') else ' '
+    return separator.join(sentence for sentence in sentences if sentence)
+
+
+class TranslationBackend:
+    """
+    Base class of the translation services. A backend is created once and reused for every request, so it can keep
+    its HTTP connections open between calls and sessions.
+    """
+
+    name = None
+
+    def translate_batch(self, texts, source, target, context=None, formality=None):
+        """
+        Translate several texts in one request.
+
+        Args:
+            texts (list): Texts to translate.
+            source (str): Source language code, or None to detect it.
+            target (str): Target language code.
+            context (str): Description of the conversation to guide the translation, if supported.
+            formality (str): Formality of the translation, if supported.
+
+        Returns:
+            list: Translations in the same order as texts.
+        """
+        raise NotImplementedError
+
+    async def translate_batch_async(self, texts, source, target, context=None, formality=None, timeout=None):
+        """
+        Translate several texts in one request without blocking the event loop. See translate_batch for the
+        arguments. Backends without an async client run translate_batch in a worker thread.
+
+        Args:
+            timeout (float): Seconds to wait for the response, or None to wait as long as the service takes.
+
+        Returns:
+            list: Translations in the same order as texts.
+        """
+        return await asyncio.wait_for(asyncio.to_thread(self.translate_batch, texts, source, target, context, formality),
+                                      timeout)
+
+    def members(self):
+        """
+        Get the backends whose translations this backend returns, most preferred first. Translations are cached
+        under the name of the backend that made them.
+        """
+        return [self]
+
+    def translate_batch_answered(self, texts, source, target, context=None, formality=None):
+        """
+        Translate several texts in one request. See translate_batch for the arguments.
+
+        Returns:
+            tuple: The translations, and the member backend that made them.
+        """
+        return self.translate_batch(texts, source, target, context=context, formality=formality), self
+
+    async def translate_batch_answered_async(self, texts, source, target, context=None, formality=None, timeout=None):
+        """
+        Translate several texts in one request without blocking the event loop. See translate_batch_async for the
+        arguments.
+
+        Returns:
+            tuple: The translations, and the member backend that made them.
+        """
+        return await self.translate_batch_async(texts, source, target, context=context, formality=formality,
+                                                timeout=timeout), self
+
+
+class DeepLBackend(TranslationBackend):
+    """
+    Translation with DeepL, through one long-lived deepl.Translator whose HTTP session is reused across requests.
+    Async requests go to the same REST API through a long-lived httpx.AsyncClient.
+    """
+
+    name = 'deepl'
+
+    def __init__(self, auth_key=None, server_url=None):
+        """
+        Initialize the DeepL backend.
+
+        Args:
+            auth_key (str): DeepL API key. Defaults to the DEEPL_API_KEY environment variable.
+            server_url (str): Alternative DeepL server, e.g. a local stub server. Defaults to the DEEPL_SERVER_URL
+                environment variable.
+        """
+        import deepl
+
+        auth_key = auth_key or os.getenv("DEEPL_API_KEY")
+        server_url = server_url or os.getenv("DEEPL_SERVER_URL")
+        if not auth_key:
+            raise ValueError(f"No API key set. \n Please set your DeepL API key in your environment config as the 'DEEPL_API_KEY' variable")
+        self.translator = deepl.Translator(auth_key, server_url=server_url)
+        self.auth_key = auth_key
+        # Free API keys end in ':fx' and are served from a different host
+        self.server_url = server_url or ("https://api-free.deepl.com" if auth_key.endswith(':fx') else "https://api.deepl.com")
+        self.async_client = None  # Created on first async request, in the event loop that uses it
+
+    def translate_batch(self, texts, source, target, context=None, formality=None):
+        # https://developers.deepl.com/docs/api-reference/translate
+        results = self.translator.translate_text(texts, source_lang=source, target_lang=target, context=context,
+                                                 formality=formality or 'default')
+        return [result.text for result in results]
+
+    async def translate_batch_async(self, texts, source, target, context=None, formality=None, timeout=None):
+        import httpx
+
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(base_url=self.server_url,
+                                                  headers={'Authorization': f'DeepL-Auth-Key {self.auth_key}'})
+        request = {'text': texts, 'target_lang': target, 'formality': formality or 'default'}
+        if source:
+            request['source_lang'] = source
+        if context:
+            request['context'] = context
+        response = await self.async_client.post('/v2/translate', json=request, timeout=timeout)
+        response.raise_for_status()
+        return [translation['text'] for translation in response.json()['translations']]
+
+
+# Google Translate codes of the DeepL language codes used by Lumino
+GOOGLE_LANGUAGES = {'EN': 'en', 'EN-GB': 'en', 'EN-US': 'en', 'ZH': 'zh-CN', 'ZH-HANS': 'zh-CN', 'ZH-HANT': 'zh-TW'}
+
+
+class GoogleBackend(TranslationBackend):
+    """
+    Translation with Google Translate through deep_translator. One GoogleTranslator is kept per language pair.
+    Google Translate does not support a context or formality, so they are ignored. DeepL language codes are
+    converted, so it can stand in for DeepL.
+    """
+
+    name = 'google'
+
+    def __init__(self):
+        self.translators = {}  # (source, target) -> GoogleTranslator
+        self.lock = threading.Lock()
+
+    def translator(self, source, target):
+        """
+        Get the translator for a language pair, creating it on first use.
+        """
+        with self.lock:
+            if (source, target) not in self.translators:
+                from deep_translator import GoogleTranslator
+
+                self.translators[(source, target)] = GoogleTranslator(source=source, target=target)
+            return self.translators[(source, target)]
+
+    def translate_batch(self, texts, source, target, context=None, formality=None):
+        # https://pypi.org/project/deep-translator/#google-translate-1
+        source = GOOGLE_LANGUAGES.get(source.upper(), source) if source else 'auto'
+        return self.translator(source, GOOGLE_LANGUAGES.get(target.upper(), target)).translate_batch(texts)
+
+
+class BackendStats:
+    """
+    Latency and error rate of a translation backend over its recent requests, with a circuit breaker.
+
+    After failure_threshold consecutive failures the circuit opens and the backend is skipped for reset_timeout
+    seconds. A single trial request is then let through: the circuit closes if it succeeds and opens again if not.
+    """
+
+    def __init__(self, name, window=200, failure_threshold=5, reset_timeout=30.0):
+        """
+        Initialize the statistics of a backend.
+
+        Args:
+            name (str): Name of the backend, used as the metrics label.
+            window (int): Number of recent requests the latency and error rate are computed over.
+            failure_threshold (int): Consecutive failures after which the circuit opens.
+            reset_timeout (float): Seconds the circuit stays open before a trial request is let through.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latencies = deque(maxlen=window)  # Seconds taken by recent successful requests
+        self.errors = deque(maxlen=window)  # Whether each recent request failed
+        self.consecutive_failures = 0
+        self.opened = None  # Monotonic time the circuit opened, None while it is closed
+        self.trial = False  # Whether the trial request of an open circuit is running
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Check whether a request may be sent to the backend, claiming the trial request of an open circuit.
+
+        Returns:
+            bool: True if the request may be sent.
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, latency=None, error=False):
+        """
+        Record the outcome of a request.
+
+        Args:
+            latency (float): Seconds the request took, for a successful request.
+            error (bool): Whether the request failed.
+        """
+        with self.lock:
+            self.errors.append(error)
+            if self.opened is not None and not self.trial:
+                # Sent before the circuit opened; only the trial request decides whether it closes
+                if not error:
+                    self.latencies.append(latency)
+                return
+            if error:
+                self.consecutive_failures += 1
+                if self.trial or self.consecutive_failures >= self.failure_threshold:
+                    self.opened = time.monotonic()
+                    TRANSLATION_CIRCUIT_OPEN.labels(self.name).set(1)
+            else:
+                self.latencies.append(latency)
+                self.consecutive_failures = 0
+                self.opened = None
+                TRANSLATION_CIRCUIT_OPEN.labels(self.name).set(0)
+            self.trial = False
+
+    def abandon(self):
+        """
+        Record that a request was cancelled before it finished, releasing the trial request if it was one.
+        """
+        with self.lock:
+            self.trial = False
+
+    def p95(self, min_samples=20):
+        """
+        Get the 95th percentile latency of recent successful requests.
+
+        Args:
+            min_samples (int): Fewest requests the percentile is computed from.
+
+        Returns:
+            float: The latency in seconds, or None if there are fewer than min_samples requests.
+        """
+        with self.lock:
+            if len(self.latencies) < min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+
+    def snapshot(self):
+        """
+        Get the current statistics.
+
+        Returns:
+            dict: p95 latency, error rate over the window and whether the circuit is open.
+        """
+        p95 = self.p95()
+        with self.lock:
+            error_rate = sum(self.errors) / len(self.errors) if self.errors else 0.0
+            return {'p95_seconds': p95, 'error_rate': error_rate, 'circuit_open': self.opened is not None}
+
+
+class HedgedRouterBackend(TranslationBackend):
+    """
+    Route translations to a primary backend, hedged with a secondary backend.
+
+    A request goes to the primary backend first. If it has not answered by the hedge delay, by default the primary's
+    recent p95 latency, the same request is also sent to the secondary backend and whichever answers first wins.
+    A failed request fails over to the secondary right away. Latency and errors are tracked per backend, and a
+    backend whose circuit breaker is open is skipped, so the secondary becomes the first choice while the primary
+    is failing.
+
+    Blocking requests run in a small thread pool; a request that lost the race finishes in the background and is
+    still counted in the statistics. Async requests that lost are cancelled.
+    """
+
+    def __init__(self, primary, secondary, hedge_delay=None, default_hedge_delay=1.0, min_hedge_delay=0.2,
+                 max_workers=8, **breaker_options):
+        """
+        Initialize the router.
+
+        Args:
+            primary (TranslationBackend): Backend tried first.
+            secondary (TranslationBackend): Backend hedged to.
+            hedge_delay (float): Fixed seconds to wait for a backend before hedging, or None to use its p95 latency.
+            default_hedge_delay (float): Seconds to wait before enough latencies are known for a p95.
+            min_hedge_delay (float): Fewest seconds to wait before hedging, so fast backends are not always hedged.
+            max_workers (int): Threads sending blocking requests.
+            **breaker_options: Options of the BackendStats of each backend, e.g. failure_threshold.
+        """
+        self.name = f"{primary.name}+{secondary.name}"
+        self.backends = [primary, secondary]
+        self.stats = {backend: BackendStats(backend.name, **breaker_options) for backend in self.backends}
+        self.hedge_delay = hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="translation-router")
+
+    def delay(self, backend):
+        """
+        Get the seconds to wait for a backend before hedging.
+        """
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        p95 = self.stats[backend].p95()
+        return max(self.min_hedge_delay, p95 if p95 is not None else self.default_hedge_delay)
+
+    def call(self, backend, texts, source, target, context, formality):
+        """
+        Send a blocking request to a backend, recording its latency or failure.
+        """
+        start = time.monotonic()
+        try:
+            result = backend.translate_batch(texts, source, target, context=context, formality=formality)
+        except Exception:
+            self.record_failure(backend)
+            raise
+        self.record_success(backend, time.monotonic() - start)
+        return result
+
+    async def call_async(self, backend, texts, source, target, context, formality, timeout):
+        """
+        Send an async request to a backend, recording its latency or failure.
+        """
+        start = time.monotonic()
+        try:
+            result = await backend.translate_batch_async(texts, source, target, context=context, formality=formality,
+                                                         timeout=timeout)
+        except asyncio.CancelledError:
+            self.stats[backend].abandon()
+            raise
+        except Exception:
+            self.record_failure(backend)
+            raise
+        self.record_success(backend, time.monotonic() - start)
+        return result
+
+    def record_success(self, backend, latency):
+        self.stats[backend].record(latency=latency)
+        TRANSLATION_BACKEND_SECONDS.labels(backend.name).observe(latency)
+
+    def record_failure(self, backend):
+        self.stats[backend].record(error=True)
+        TRANSLATION_BACKEND_ERRORS.labels(backend.name).inc()
+
+    @staticmethod
+    def count_outcome(hedged, first_won):
+        """
+        Count a request by whether it was hedged and which backend answered it.
+        """
+        TRANSLATION_HEDGES.labels('first_won' if first_won else 'hedge_won' if hedged else 'not_hedged').inc()
+
+    def members(self):
+        return list(self.backends)
+
+    def translate_batch(self, texts, source, target, context=None, formality=None):
+        return self.translate_batch_answered(texts, source, target, context=context, formality=formality)[0]
+
+    async def translate_batch_async(self, texts, source, target, context=None, formality=None, timeout=None):
+        return (await self.translate_batch_answered_async(texts, source, target, context=context, formality=formality,
+                                                          timeout=timeout))[0]
+
+    def translate_batch_answered(self, texts, source, target, context=None, formality=None):
+        remaining = iter(self.backends)
+
+        def launch():
+            for backend in remaining:
+                if self.stats[backend].allow():
+                    return backend, self.executor.submit(self.call, backend, texts, source, target, context, formality)
+            return None, None
+
+        first, first_future = launch()
+        if first_future is None:
+            raise RuntimeError("All translation backends are unavailable")
+        launched = {first_future: first}
+        pending = {first_future}
+        hedged = False
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=None if hedged else self.delay(first), return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                self.count_outcome(hedged, future is first_future)
+                return result, launched[future]
+            if not hedged:
+                # The first backend is slow or failed: send the request to the next one as well
+                hedged = True
+                backend, future = launch()
+                if future is not None:
+                    launched[future] = backend
+                    pending.add(future)
+        raise error
+
+    async def translate_batch_answered_async(self, texts, source, target, context=None, formality=None, timeout=None):
+        remaining = iter(self.backends)
+
+        def launch():
+            for backend in remaining:
+                if self.stats[backend].allow():
+                    return backend, asyncio.create_task(
+                        self.call_async(backend, texts, source, target, context, formality, timeout))
+            return None, None
+
+        first, first_task = launch()
+        if first_task is None:
+            raise RuntimeError("All translation backends are unavailable")
+        launched = {first_task: first}
+        pending = {first_task}
+        hedged = False
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=None if hedged else self.delay(first),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    self.count_outcome(hedged, task is first_task)
+                    return task.result(), launched[task]
+                if not hedged:
+                    hedged = True
+                    backend, task = launch()
+                    if task is not None:
+                        launched[task] = backend
+                        pending.add(task)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()  # The request that lost the race
+
+    def backend_stats(self):
+        """
+        Get the statistics of each backend.
+
+        Returns:
+            dict: Statistics by backend name, see BackendStats.snapshot.
+        """
+        return {backend.name: self.stats[backend].snapshot() for backend in self.backends}
+
+
+def hedged_backend(auth_key=None, server_url=None, secondary_server_url=None, **options):
+    """
+    Create the default router: DeepL hedged with Google Translate, or with a second DeepL server if one is given,
+    e.g. a local stub server.
+
+    Args:
+        auth_key (str): DeepL API key.
+        server_url (str): Alternative server of the primary DeepL backend.
+        secondary_server_url (str): DeepL server used as the secondary backend instead of Google Translate.
+            Defaults to the DEEPL_SECONDARY_SERVER_URL environment variable.
+        **options: Options of the HedgedRouterBackend.
+
+    Returns:
+        HedgedRouterBackend: The router.
+    """
+    primary = DeepLBackend(auth_key, server_url)
+    secondary_server_url = secondary_server_url or os.getenv("DEEPL_SECONDARY_SERVER_URL")
+    if secondary_server_url:
+        secondary = DeepLBackend(auth_key, secondary_server_url)
+        secondary.name = 'deepl-secondary'
+    else:
+        secondary = GoogleBackend()
+    return HedgedRouterBackend(primary, secondary, **options)
+
+
+# Available translation backends by name
+BACKENDS = {
+    'deepl': DeepLBackend,
+    'google': GoogleBackend,
+    'hedged': hedged_backend,
+}
+
+
+class TranslationClient:
+    """
+    Translate through a backend, answering repeated texts from the translation cache and sending everything else in
+    a single batched request.
+    """
+
+    def __init__(self, backend, cache=None):
+        """
+        Initialize the translation client.
+
+        Args:
+            backend (TranslationBackend): The backend doing the translations.
+            cache (TranslationCache): Cache of translations, or None to always call the backend.
+        """
+        self.backend = backend
+        self.cache = cache
+
+    def translate(self, text, source, target, context=None, scenario=None, formality=None):
+        """
+        Translate a single text. See translate_batch for the arguments.
+
+        Returns:
+            str: The translation.
+        """
+        return self.translate_batch([text], source, target, context=context, scenario=scenario, formality=formality)[0]
+
+    def translate_batch(self, texts, source, target, context=None, scenario=None, formality=None, cacheable=None):
+        """
+        Translate several texts, sending the ones that are not cached to the backend in one request.
+
+        Args:
+            texts (list): Texts to translate.
+            source (str): Source language code, or None to detect it.
+            target (str): Target language code.
+            context (str): Description of the conversation to guide the translation.
+            scenario (str): Name of the scenario used in the cache key. Defaults to the context.
+            formality (str): Formality of the translation.
+            cacheable (int): Number of leading texts whose translations are cached, or None for all. Texts that are
+                still changing, e.g. the unfinished tail of a line, are looked up but not cached.
+
+        Returns:
+            list: Translations in the same order as texts.
+        """
+        scenario = scenario if scenario is not None else context
+        translations, missing = self.lookup(texts, source, target, scenario, formality)
+        if missing:
+            results, answered = self.backend.translate_batch_answered(list(missing), source, target, context=context,
+                                                                      formality=formality)
+            self.store(translations, missing, results, answered, source, target, scenario, formality, cacheable)
+        return translations
+
+    async def translate_batch_async(self, texts, source, target, context=None, scenario=None, formality=None,
+                                    timeout=None, cacheable=None):
+        """
+        Translate several texts without blocking the event loop. See translate_batch for the arguments.
+
+        Args:
+            timeout (float): Seconds to wait for the backend, or None to wait as long as it takes.
+
+        Returns:
+            list: Translations in the same order as texts.
+        """
+        scenario = scenario if scenario is not None else context
+        translations, missing = self.lookup(texts, source, target, scenario, formality, disk=False)
+        if missing and self.cache and self.cache.db is not None:
+            # SQLite lookups block, so the texts missed in memory are looked up on disk in a worker thread
+            await asyncio.to_thread(self.lookup_missing, translations, missing, source, target, scenario, formality)
+        elif missing and self.cache:
+            self.lookup_missing(translations, missing, source, target, scenario, formality)
+        if missing:
+            results, answered = await self.backend.translate_batch_answered_async(
+                list(missing), source, target, context=context, formality=formality, timeout=timeout)
+            self.store(translations, missing, results, answered, source, target, scenario, formality, cacheable)
+        return translations
+
+    @staticmethod
+    def cache_source(backend, source):
+        """
+        Get the source language used in cache keys, which includes the backend that made the translation since
+        backends translate differently.
+        """
+        return f"{backend.name}:{source or 'auto'}"
+
+    def lookup(self, texts, source, target, scenario, formality, disk=True):
+        """
+        Answer the texts that are cached, preferring the translations of the most preferred member backend.
+
+        Args:
+            disk (bool): Whether to look in the SQLite tier of the cache, or only in memory.
+
+        Returns:
+            tuple: The translations, empty for texts that are not cached, and a dict mapping each text that needs
+                to be sent to the backend to its positions.
+        """
+        translations = [''] * len(texts)
+        missing = {}  # text -> positions of texts that need to be sent to the backend
+        for i, text in enumerate(texts):
+            if not text.strip():
+                continue
+            cached = self.cached(text, source, target, scenario, formality, disk)
+            if cached is not None:
+                translations[i] = cached
+            else:
+                missing.setdefault(text, []).append(i)
+        return translations, missing
+
+    def lookup_missing(self, translations, missing, source, target, scenario, formality):
+        """
+        Answer texts missed in memory from the whole cache, removing them from missing. May block on SQLite.
+        """
+        for text in list(missing):
+            cached = self.cached(text, source, target, scenario, formality, disk=True)
+            if cached is not None:
+                for i in missing.pop(text):
+                    translations[i] = cached
+
+    def cached(self, text, source, target, scenario, formality, disk):
+        """
+        Get the cached translation of a text by the most preferred member backend, or None if there is none.
+        """
+        if not self.cache:
+            return None
+        members = self.backend.members()
+        for backend in members:
+            cached = self.cache.get(text, self.cache_source(backend, source), target, scenario, formality,
+                                    count_miss=backend is members[-1], disk=disk)
+            if cached is not None:
+                return cached
+        return None
+
+    def store(self, translations, missing, results, answered, source, target, scenario, formality, cacheable=None):
+        """
+        Fill in the translations of the texts sent to the backend and cache the ones among the first cacheable texts
+        under the backend that answered.
+        """
+        for (text, positions), translation in zip(missing.items(), results):
+            for i in positions:
+                translations[i] = translation
+            if self.cache and (cacheable is None or positions[0] < cacheable):
+                self.cache.put(text, self.cache_source(answered, source), target, scenario, formality, translation)
+
+
+shared_clients = {}  # Translation clients shared by all sessions, by backend and options
+shared_clients_lock = threading.Lock()
+
+
+def get_translation_client(backend='deepl', **options):
+    """
+    Get the process-wide translation client for a backend, creating it on first use.
+
+    Args:
+        backend (str): Name of the backend, one of BACKENDS.
+        **options: Options passed to the backend, e.g. auth_key.
+
+    Returns:
+        TranslationClient: The shared client.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown translation backend '{backend}', choose one of {', '.join(BACKENDS)}")
+    key = (backend, tuple(sorted(options.items())))
+    with shared_clients_lock:
+        if key not in shared_clients:
+            shared_clients[key] = TranslationClient(BACKENDS[backend](**options), get_translation_cache())
+        return shared_clients[key]
+
+
+class IncrementalTranslator:
+    """
+    Translate a growing line of speech one sentence at a time.
+
+    Sentences that are followed by more speech are committed: they are translated once and the result is kept.
+    Only the unfinished tail of the line is sent for translation again on each update, so the cost of an update
+    does not grow with the length of the line. Newly committed sentences and the tail are sent in a single batch.
+    """
+
+    def __init__(self, translate_batch_fn, translate_batch_async_fn=None):
+        """
+        Initialize the incremental translator.
+
+        Args:
+            translate_batch_fn (callable): Function called as translate_batch_fn(texts, source=..., target=...,
+                cacheable=...) returning the list of translations. The tail is cacheable once it is a complete sentence.
+            translate_batch_async_fn (callable): Coroutine function called the same way, used by update_async.
+        """
+        self.translate_batch_fn = translate_batch_fn
+        self.translate_batch_async_fn = translate_batch_async_fn
+        self.direction = None  # (source, target) the committed translations were made for
+        self.committed = []  # List of (sentence, translation) pairs that will not be translated again
+
+    def reset(self):
+        """
+        Forget all committed translations, e.g. when a new conversation starts.
+        """
+        self.direction = None
+        self.committed = []
+
+    def update(self, text, source, target):
+        """
+        Translate the latest version of a line.
+
+        Args:
+            text (str): The full line spoken so far.
+            source (str): Source language code.
+            target (str): Target language code.
+
+        Returns:
+            str: Translation of the full line.
+        """
+        kept, pending = self.plan(text, source, target)
+        if not pending:
+            return ''
+        # Translate the newly committed sentences together with the tail in one request
+        translations = self.translate_batch_fn(pending, source=source, target=target, cacheable=cacheable_count(pending))
+        return self.complete(kept, pending, translations, target)
+
+    async def update_async(self, text, source, target):
+        """
+        Translate the latest version of a line without blocking the event loop. See update for the arguments.
+
+        If the update is cancelled while waiting for the translation, the committed translations are unchanged.
+
+        Returns:
+            str: Translation of the full line.
+        """
+        kept, pending = self.plan(text, source, target)
+        if not pending:
+            return ''
+        translations = await self.translate_batch_async_fn(pending, source=source, target=target,
+                                                           cacheable=cacheable_count(pending))
+        return self.complete(kept, pending, translations, target)
+
+    def plan(self, text, source, target):
+        """
+        Split a line into the committed translations that can be reused and the sentences to translate.
+
+        Returns:
+            tuple: The reusable (sentence, translation) pairs, and the sentences to translate, the last of which is
+                the unfinished tail. Both are empty for an empty line.
+        """
+        if self.direction != (source, target):
+            self.reset()
+            self.direction = (source, target)
+
+        sentences = split_sentences(text)
+        committed = sentences[:-1]
+
+        # Keep the committed translations that still match the start of the line
+        keep = 0
+        while keep < min(len(self.committed), len(committed)) and self.committed[keep][0] == committed[keep]:
+            keep += 1
+        return self.committed[:keep], sentences[keep:]
+
+    def complete(self, kept, pending, translations, target):
+        """
+        Commit the translations of the newly committed sentences and join the translation of the line.
+
+        Returns:
+            str: Translation of the full line.
+        """
+        self.committed = kept + list(zip(pending[:-1], translations[:-1]))
+        return join_sentences([translation for _, translation in self.committed] + translations[-1:], target)
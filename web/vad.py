@@ -0,0 +1,118 @@
+import numpy as np
+
+from audio import SAMPLE_RATE
+
+
+class VoiceActivityDetector:
+    """
+    Lightweight voice activity detection on float32 audio, run before Whisper.
+
+    Audio is split into short frames, and the energy (RMS in dBFS) and zero-crossing rate of all frames are computed
+    at once with NumPy. Speech starts on a frame louder than start_db whose zero-crossing rate is below max_zcr
+    (broadband noise crosses zero far more often than voiced speech), and only ends once a frame falls below the
+    lower stop_db, so short dips inside words do not cut speech. Speech is extended by hangover_ms after it ends.
+
+    Silent chunks are skipped and silence around speech is trimmed, which saves Whisper work and stops it
+    hallucinating text on silence. The amount of audio dropped is counted.
+    """
+
+    def __init__(self, frame_ms=30, start_db=-40.0, stop_db=-48.0, max_zcr=0.35, hangover_ms=300, padding_ms=200,
+                 sample_rate=SAMPLE_RATE):
+        """
+        Initialize the voice activity detector.
+
+        Args:
+            frame_ms (float): Length of a frame in milliseconds.
+            start_db (float): Frame energy in dBFS above which speech starts.
+            stop_db (float): Frame energy in dBFS below which speech ends.
+            max_zcr (float): Highest zero-crossing rate (crossings per sample) of a frame that can start speech.
+            hangover_ms (float): Milliseconds speech is extended after it ends.
+            padding_ms (float): Milliseconds of audio kept around speech when trimming.
+            sample_rate (int): Sample rate of the audio.
+        """
+        self.frame_length = int(sample_rate * frame_ms / 1000)
+        self.start_db = start_db
+        self.stop_db = stop_db
+        self.max_zcr = max_zcr
+        self.hangover_frames = int(hangover_ms / frame_ms)
+        self.padding = int(sample_rate * padding_ms / 1000)
+        self.sample_rate = sample_rate
+        self.in_speech = False  # Whether the previous chunk ended in speech
+        self.total_samples = 0  # Samples checked
+        self.dropped_samples = 0  # Samples dropped as silence
+
+    def reset(self):
+        """
+        Reset the speech state and counters, e.g. for a new session.
+        """
+        self.in_speech = False
+        self.total_samples = 0
+        self.dropped_samples = 0
+
+    def speech_frames(self, audio):
+        """
+        Decide which frames of the audio contain speech.
+
+        Args:
+            audio (np.ndarray): float32 samples in [-1, 1].
+
+        Returns:
+            np.ndarray: Boolean speech decision per frame. A partial last frame is not included.
+        """
+        count = len(audio) // self.frame_length
+        if count == 0:
+            return np.zeros(0, dtype=bool)
+        frames = audio[:count * self.frame_length].reshape(count, self.frame_length)
+
+        energy = np.einsum('ij,ij->i', frames, frames) / self.frame_length
+        energy_db = 10 * np.log10(energy + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / self.frame_length
+
+        # Hysteresis: 1 where speech starts, 0 where it stops, -1 where the previous state carries on
+        marks = np.where((energy_db >= self.start_db) & (zcr <= self.max_zcr), 1, np.where(energy_db < self.stop_db, 0, -1))
+        last_mark = np.where(marks >= 0, np.arange(count), -1)
+        np.maximum.accumulate(last_mark, out=last_mark)
+        speech = np.where(last_mark >= 0, marks[last_mark], int(self.in_speech)).astype(bool)
+        self.in_speech = bool(speech[-1])
+
+        if self.hangover_frames:
+            speech = np.convolve(speech, np.ones(self.hangover_frames + 1))[:count] > 0
+        return speech
+
+    def trim(self, audio):
+        """
+        Drop the audio if it is silent, otherwise trim the silence before and after speech.
+
+        Args:
+            audio (np.ndarray): float32 samples in [-1, 1].
+
+        Returns:
+            np.ndarray: View of the audio around the speech, or None if there is no speech.
+        """
+        self.total_samples += len(audio)
+        speech = np.flatnonzero(self.speech_frames(audio))
+        if len(speech) == 0:
+            self.dropped_samples += len(audio)
+            return None
+
+        start = max(0, int(speech[0]) * self.frame_length - self.padding)
+        end = (int(speech[-1]) + 1) * self.frame_length + self.padding
+        if speech[-1] == len(audio) // self.frame_length - 1:
+            end = len(audio)  # Speech runs into the partial last frame
+        end = min(end, len(audio))
+        self.dropped_samples += len(audio) - (end - start)
+        return audio[start:end]
+
+    def stats(self):
+        """
+        Get how much audio the detector has checked and dropped.
+
+        Returns:
+            dict: Seconds of audio checked and dropped, and the dropped fraction.
+        """
+        return {
+            'total_seconds': self.total_samples / self.sample_rate,
+            'dropped_seconds': self.dropped_samples / self.sample_rate,
+            'dropped_ratio': self.dropped_samples / self.total_samples if self.total_samples else 0.0,
+        }
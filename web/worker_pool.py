@@ -0,0 +1,422 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from audio import SAMPLE_RATE
+from metrics import QUEUE_DEPTH
+
+# Number of ASR worker processes, or 0 to transcribe in the server process
+ASR_WORKERS = int(os.getenv("LUMINO_ASR_WORKERS", "0"))
+
+
+def split_cores(workers):
+    """
+    Split the CPU cores this process may run on into one contiguous subset per worker.
+
+    Args:
+        workers (int): Number of workers.
+
+    Returns:
+        list: A list of core numbers per worker. Workers share cores if there are fewer cores than workers.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    if len(cores) < workers:
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    return [[int(core) for core in subset] for subset in np.array_split(cores, workers)]
+
+
+def worker_main(index, cores, profile, model_name, requests, results):
+    """
+    Run an ASR worker process: load a Whisper model pinned to a subset of cores, then transcribe the requests of its
+    queue. Requests are decoded by an InferenceScheduler, so requests arriving together are still batched.
+
+    Args:
+        index (int): Number of the worker.
+        cores (list): CPU cores the worker runs on.
+        profile (str): Inference profile, see inference.PROFILES.
+        model_name (str): Whisper model instead of the model of the profile, or None.
+        requests (multiprocessing.Queue): Requests of the worker, None to stop it.
+        results (multiprocessing.Queue): Queue the worker reports readiness and results to.
+    """
+    from inference import InferenceScheduler
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    scheduler = InferenceScheduler(model_name, profile=profile, threads=len(cores))
+    try:
+        scheduler.wait_until_ready()
+    except RuntimeError as e:
+        results.put(('ready', index, str(e)))
+        return
+    results.put(('ready', index, None))
+
+    slots = {}  # Name -> attached shared memory slot of the pool
+    while True:
+        message = requests.get()
+        if message is None:
+            scheduler.stop()
+            return
+        request_id, name, length, temporary, language, languages, prompt = message
+        block = slots.get(name) or shared_memory.SharedMemory(name=name)
+        audio = np.ndarray((length,), dtype=np.float32, buffer=block.buf).copy()
+        if temporary:
+            block.close()
+        else:
+            slots[name] = block
+
+        def report(future, request_id=request_id):
+            try:
+                results.put(('result', request_id, future.result(), None))
+            except Exception as e:
+                results.put(('result', request_id, None, f"{type(e).__name__}: {e}"))
+        scheduler.submit(audio, language, languages, prompt).add_done_callback(report)
+
+
+class PoolRequest:
+    """
+    A chunk of audio waiting to be transcribed by a worker process, with the future that receives its result.
+    """
+
+    def __init__(self, request_id, session, audio, language, languages, prompt):
+        self.request_id = request_id
+        self.session = session  # Session the chunk belongs to, whose results are delivered in order
+        self.audio = audio  # float32 samples in [-1, 1] at 16 kHz
+        self.language = language
+        self.languages = languages
+        self.prompt = prompt
+        self.future = Future()
+        self.outcome = None  # (result, error) once the worker answered, until the session's earlier chunks are done
+        self.worker = None  # Worker transcribing the chunk
+        self.block = None  # Shared memory holding the audio while the worker transcribes it
+        self.temporary = False  # Whether the block was created for this chunk only
+
+
+class ProcessInferencePool:
+    """
+    Transcribe in a pool of worker processes, each with its own Whisper model, instead of in the server process.
+
+    Whisper holds the GIL for long stretches, so transcribing in the server process slows down socket handling for
+    every client. Each worker is pinned to its own subset of the CPU cores and runs an InferenceScheduler.
+
+    Audio is handed to the workers through preallocated shared memory slots, so chunks are not pickled. A chunk
+    waits in the server until a slot is free, which bounds the work in flight to the number of slots without ever
+    blocking the caller. At most max_pending chunks wait: when the pool falls behind, the oldest waiting chunk of
+    the submitting session is dropped, or the oldest waiting chunk if the session has none, as the stages of the
+    pipeline drop stale work. A dropped chunk resolves to a result with no text and 'dropped' set. Chunks of a
+    session go to the worker already transcribing its earlier chunks, and the results of a session are delivered in
+    the order its chunks were submitted.
+
+    Has the interface of InferenceScheduler, so it can be used in its place.
+    """
+
+    def __init__(self, workers=2, model_name=None, profile=None, slots_per_worker=4, slot_seconds=30, max_pending=16):
+        """
+        Start the worker processes, which load their models in the background.
+
+        Args:
+            workers (int): Number of worker processes.
+            model_name (str): Whisper model instead of the model of the profile.
+            profile (str): Inference profile, see inference.PROFILES. Defaults to inference.DEFAULT_PROFILE.
+            slots_per_worker (int): Shared memory slots per worker, the chunks each worker may have in flight.
+            slot_seconds (float): Seconds of audio a slot holds. Longer chunks get shared memory of their own.
+            max_pending (int): Maximum number of chunks waiting for a slot.
+        """
+        from inference import DEFAULT_PROFILE, PROFILES
+
+        self.profile = profile or DEFAULT_PROFILE
+        self.model_name = model_name or PROFILES[self.profile]['model']
+        self.slot_samples = int(slot_seconds * SAMPLE_RATE)
+        self.ready = threading.Event()  # Set once every worker has loaded its model or failed to
+        self.load_error = None  # Error if no worker could load its model
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.max_pending = max_pending
+        self.pending = deque()  # Requests waiting for a free slot, oldest first
+        self.pending_changed = threading.Condition(self.lock)
+        self.stop_requested = False  # Set once stop is called, the dispatcher exits when no request is waiting
+        self.in_flight = {}  # Request ID -> request being transcribed by a worker
+        self.sessions = {}  # Session -> deque of its requests not delivered yet, oldest first
+        self.loads = [0] * workers  # Requests in flight per worker
+        self.alive = [False] * workers  # Whether each worker has loaded its model and is running
+        self.reported = set()  # Workers that reported whether they loaded their model
+        self.exited = set()  # Workers whose process exited
+        self.worker_errors = []
+        self.stopped = False  # Set once the workers have been stopped
+        self.free_slots = queue.Queue()
+        self.blocks = []
+        self.processes = []
+        if multiprocessing.parent_process() is not None:
+            return  # Imported by a worker process, which must not start workers of its own
+
+        for _ in range(workers * slots_per_worker):
+            block = shared_memory.SharedMemory(create=True, size=self.slot_samples * 4)
+            self.blocks.append(block)
+            self.free_slots.put(block)
+        # Spawned rather than forked, since the server process runs threads
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        self.queues = []
+        for index, cores in enumerate(split_cores(workers)):
+            requests = context.Queue()
+            process = context.Process(target=worker_main, name=f"asr-worker-{index}", daemon=True,
+                                      args=(index, cores, self.profile, model_name, requests, self.results))
+            process.start()
+            self.queues.append(requests)
+            self.processes.append(process)
+        threading.Thread(target=self.collect, name="asr-pool-results", daemon=True).start()
+        threading.Thread(target=self.dispatch, name="asr-pool-dispatch", daemon=True).start()
+
+    def is_ready(self):
+        """
+        Check whether the workers have loaded their models.
+
+        Returns:
+            bool: True once transcriptions can be served, False while loading and if no worker loaded its model.
+        """
+        return self.ready.is_set() and self.load_error is None
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Wait for the workers to load their models.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+
+        Returns:
+            bool: True if the workers are ready.
+
+        Raises:
+            RuntimeError: If no worker could load its model.
+        """
+        self.ready.wait(timeout)
+        if self.load_error is not None:
+            raise RuntimeError(f"Whisper model failed to load: {self.load_error}")
+        return self.ready.is_set()
+
+    def submit(self, audio, language=None, languages=None, prompt=None, session=None):
+        """
+        Queue a chunk of audio for transcription by a worker.
+
+        Args:
+            audio (np.ndarray): float32 samples in [-1, 1] at 16 kHz.
+            language (str): Whisper language code to decode in, or None to detect it.
+            languages (tuple): Whisper language codes detection may choose from, or None for any language.
+            prompt (str): Text transcribed before the chunk, to condition the decoding on.
+            session (str): Session the chunk belongs to. Results of a session resolve in submission order.
+
+        Returns:
+            Future: Resolves to a dict with the transcribed 'text' and the decoded 'language', or with 'dropped' set
+                and no text or language if the chunk was dropped because the pool fell behind.
+        """
+        request = PoolRequest(next(self.request_ids), session, audio, language, languages, prompt)
+        dropped = None
+        with self.lock:
+            self.sessions.setdefault(session, deque()).append(request)
+            if len(self.pending) >= self.max_pending:
+                dropped = next((waiting for waiting in self.pending if waiting.session == session), self.pending[0])
+                self.pending.remove(dropped)
+            self.pending.append(request)
+            QUEUE_DEPTH.labels('asr_pool').set(len(self.pending))
+            self.pending_changed.notify()
+        if dropped is not None:
+            print(f"ASR pool is falling behind, dropped a chunk of session {dropped.session}")
+            self.finish(dropped, {'text': '', 'language': None, 'dropped': True}, None)
+        return request.future
+
+    def transcribe(self, audio, language=None, languages=None, prompt=None, session=None):
+        """
+        Transcribe a chunk of audio, waiting for the worker to finish it.
+
+        Args:
+            audio (np.ndarray): float32 samples in [-1, 1] at 16 kHz.
+            language (str): Whisper language code to decode in, or None to detect it.
+            languages (tuple): Whisper language codes detection may choose from, or None for any language.
+            prompt (str): Text transcribed before the chunk, to condition the decoding on.
+            session (str): Session the chunk belongs to.
+
+        Returns:
+            dict: The transcribed 'text' and the decoded 'language'.
+        """
+        return self.submit(audio, language, languages, prompt, session).result()
+
+    def stop(self):
+        """
+        Stop the workers once their queued requests are done and release the shared memory.
+        """
+        with self.lock:
+            self.stop_requested = True
+            self.pending_changed.notify()
+
+    def dispatch(self):
+        """
+        Hand waiting requests to the workers as shared memory slots become free.
+        """
+        self.ready.wait()
+        while True:
+            with self.lock:
+                while not self.pending and not self.stop_requested:
+                    self.pending_changed.wait()
+                request = self.pending.popleft() if self.pending else None
+                QUEUE_DEPTH.labels('asr_pool').set(len(self.pending))
+            if request is None:
+                for requests in self.queues:
+                    requests.put(None)
+                for process in self.processes:
+                    process.join()
+                self.stopped = True
+                for block in self.blocks:
+                    block.close()
+                    block.unlink()
+                return
+            if not request.future.set_running_or_notify_cancel():
+                self.finish(request, None, None)  # Cancelled while it waited
+                continue
+            if self.load_error is not None:
+                self.finish(request, None, f"Whisper model failed to load: {self.load_error}")
+                continue
+
+            audio = np.asarray(request.audio, dtype=np.float32)
+            if len(audio) > self.slot_samples:
+                request.block = shared_memory.SharedMemory(create=True, size=len(audio) * 4)
+                request.temporary = True
+            else:
+                request.block = self.free_slots.get()  # Waits while every slot is in flight
+            np.ndarray((len(audio),), dtype=np.float32, buffer=request.block.buf)[:] = audio
+
+            with self.lock:
+                worker = self.route(request.session)
+                if worker is None:
+                    error = "No ASR worker is running"
+                else:
+                    request.worker = worker
+                    self.loads[worker] += 1
+                    self.in_flight[request.request_id] = request
+            if worker is None:
+                self.release(request)
+                self.finish(request, None, error)
+                continue
+            self.queues[worker].put((request.request_id, request.block.name, len(audio), request.temporary,
+                                     request.language, request.languages, request.prompt))
+
+    def route(self, session):
+        """
+        Choose the worker of a request: the worker transcribing earlier chunks of its session, otherwise the least
+        loaded worker. Called with the lock held.
+
+        Returns:
+            int: Index of the worker, or None if no worker is running.
+        """
+        for request in self.sessions.get(session, ()):
+            if request.worker is not None and request.request_id in self.in_flight and self.alive[request.worker]:
+                return request.worker
+        running = [worker for worker, alive in enumerate(self.alive) if alive]
+        if not running:
+            return None
+        return min(running, key=lambda worker: self.loads[worker])
+
+    def collect(self):
+        """
+        Receive readiness reports and results from the workers, and fail the requests of workers that died.
+        """
+        while True:
+            try:
+                message = self.results.get(timeout=1.0)
+            except queue.Empty:
+                if self.stopped:
+                    return
+                self.check_workers()
+                continue
+            if message[0] == 'ready':
+                _, index, error = message
+                self.worker_ready(index, error)
+                continue
+            _, request_id, result, error = message
+            with self.lock:
+                request = self.in_flight.pop(request_id, None)
+                if request is not None:
+                    self.loads[request.worker] -= 1
+            if request is not None:
+                self.release(request)
+                self.finish(request, result, error)
+
+    def worker_ready(self, index, error):
+        """
+        Record whether a worker loaded its model, and mark the pool ready once every worker has reported.
+        """
+        if index in self.reported:
+            return
+        self.reported.add(index)
+        if error is None:
+            self.alive[index] = True
+        else:
+            print(f"Error loading Whisper model in ASR worker {index}: {error}")
+            self.worker_errors.append(error)
+        if len(self.reported) == len(self.processes):
+            if not any(self.alive):
+                self.load_error = self.worker_errors[0]
+            print(f"{sum(self.alive)} of {len(self.processes)} ASR workers ready")
+            self.ready.set()
+
+    def check_workers(self):
+        """
+        Fail the requests in flight on workers that exited, and stop routing requests to them.
+        """
+        for index, process in enumerate(self.processes):
+            if process.is_alive() or index in self.exited:
+                continue
+            self.exited.add(index)
+            print(f"ASR worker {index} exited with code {process.exitcode}")
+            with self.lock:
+                self.alive[index] = False
+                lost = [request for request in self.in_flight.values() if request.worker == index]
+                for request in lost:
+                    del self.in_flight[request.request_id]
+                self.loads[index] = 0
+            self.worker_ready(index, f"exited with code {process.exitcode}")
+            for request in lost:
+                self.release(request)
+                self.finish(request, None, f"ASR worker {index} exited")
+
+    def release(self, request):
+        """
+        Free the shared memory of a request.
+        """
+        if request.temporary:
+            request.block.close()
+            request.block.unlink()
+        elif request.block is not None:
+            self.free_slots.put(request.block)
+        request.block = None
+
+    def finish(self, request, result, error):
+        """
+        Record the outcome of a request and resolve the futures of its session that are next in order.
+
+        Args:
+            request (PoolRequest): The request.
+            result (dict): Transcription result, or None if the request failed or was cancelled.
+            error (str): Error message if the request failed.
+        """
+        with self.lock:
+            request.outcome = (result, error)
+            requests = self.sessions[request.session]
+            done = []
+            while requests and requests[0].outcome is not None:
+                done.append(requests.popleft())
+            if not requests:
+                del self.sessions[request.session]
+        for request in done:
+            result, error = request.outcome
+            if request.future.cancelled():
+                continue
+            if error is not None:
+                request.future.set_exception(RuntimeError(error))
+            else:
+                request.future.set_result(result)